@@ -1,7 +1,9 @@
-import json
+import os
+import shutil
 import textwrap
+from typing import Any
 
-from utils import setup_logger
+from utils import setup_logger, StageTimer
 
 # The base class used for classification and multi-choice questions (MCQs)
 class Agent:
@@ -24,10 +26,18 @@ class Agent:
         self.config = config
         # Setup logging info
         self.exp_name = config["exp_name"] if "exp_name" in config else 'baseline'
-        self.log_path = f'log/{config["bench_name"]}/{self.exp_name}.jsonl'
-        self.logger = setup_logger(name="jsonlines_logger", log_file=self.log_path)
+        log_compression = config.get("log_compression")
+        self.log_path = f'log/{config["bench_name"]}/{self.exp_name}.jsonl' + {"gzip": ".gz", "zstd": ".zst"}.get(log_compression, "")
+        self.logger = setup_logger(
+            name="jsonlines_logger",
+            log_file=self.log_path,
+            compression=log_compression,
+            dedup_prompts=config.get("log_dedup_prompts", False)
+        )
         self.log_info = {KEY: 0 for KEY in self.LOG_KEYS}  # log information of the current data point
         self.accum_log_info = {KEY: 0 for KEY in self.LOG_KEYS}  # accum_log_info: accumulation of self.log_info through time steps
+        self.log_checkpointed = 0  # number of bytes of the log already copied into the checkpoint
+        self.timer = StageTimer()  # wall-clock time of the stages of each time step
 
     def __call__(self, prompt: str, label_set: list[str], **kwargs) -> str:
         """Generate response text using the prompt. The response should be parsed to a label in the label_set."""
@@ -51,6 +61,24 @@ class Agent:
             for key in keys:
                 assert key in train_row
 
+    def prepare_batch(self, inputs: list[dict]) -> Any:
+        """(Optional) Do the part of batch_call that only reads the memory of the agent (e.g. retrieval and prompt building).
+
+        The pipeline may call it ahead of batch_call(inputs, prepared), and drops the result if update() changed the agent in between.
+        """
+        return None
+
+    def batch_call(self, inputs: list[dict], prepared: Any = None) -> list[str]:
+        """Answer a micro-batch of inputs, and keep the log information of each input in self.batch_log_info.
+
+        The default answers the inputs one by one; agents that can generate a batch at once should override it.
+        """
+        outputs, self.batch_log_info = [], []
+        for x in inputs:
+            outputs.append(self(**x))
+            self.batch_log_info.append(self.log_info)
+        return outputs
+
     def update(self, has_feedback: bool, **feedbacks) -> bool:
         """Return True if the agent is updated in this time_step."""
         raise NotImplementedError
@@ -58,30 +86,68 @@ class Agent:
     def reset_log_info(self) -> None:
         self.log_info = {KEY: 0 for KEY in self.LOG_KEYS}
 
-    def update_log_info(self, log_data: dict) -> None:
+    def update_log_info(self, log_data: dict, log_info: dict = None) -> None:
+        """Update the log information of the current data point (or of the given log_info of a batched data point)."""
+        log_info = self.log_info if log_info is None else log_info
         for k, v in log_data.items():
             if isinstance(v, str) or isinstance(v, list):
-                self.log_info[k] = v
+                log_info[k] = v
             elif isinstance(v, int):
-                self.log_info[k] += v
+                log_info[k] += v
                 if k in self.accum_log_info.keys():
                     self.accum_log_info[k] += v
             else:
                 raise ValueError(f"error key-value pair: {k} -> {v} ({v} should be either str, int, or list)")
 
-    def get_wandb_log_info(self) -> dict:
+    def get_wandb_log_info(self, log_info: dict = None) -> dict:
+        log_info = self.log_info if log_info is None else log_info
         log_data = dict()
         for key in self.LOG_KEYS:
-            log_data[key] = self.log_info[key]
+            log_data[key] = log_info[key]
             log_data[f"total_{key}"] = self.accum_log_info[key]
         return log_data
 
-    def log(self, label_text: str = None) -> None:
-        """This method should be called at the end of each time_step."""
-        self.log_info["label_text"] = label_text
-        self.logger.info(json.dumps(self.log_info))
+    def log(self, label_text: str = None, log_info: dict = None) -> None:
+        """This method should be called at the end of each time_step (with the log_info of the data point in batched mode)."""
+        log_info = self.log_info if log_info is None else log_info
+        log_info["label_text"] = label_text
+        self.logger.info(log_info)  # serialized by the log writer thread
         self.reset_log_info()
 
+    def flush_log(self) -> None:
+        """Wait until the logged records are written to self.log_path."""
+        for handler in self.logger.handlers:
+            handler.flush()
+
+    def save_checkpoint(self, ckpt_dir: str) -> dict:
+        """Save what is needed to resume the stream into ckpt_dir, and return the (small) agent state stored with the checkpoint."""
+        # append the log records written since the last checkpoint
+        self.flush_log()
+        mode = 'ab' if self.log_checkpointed else 'wb'
+        with open(self.log_path, 'rb') as src, open(os.path.join(ckpt_dir, "log.jsonl"), mode) as dst:
+            src.seek(self.log_checkpointed)
+            shutil.copyfileobj(src, dst)
+            self.log_checkpointed = src.tell()
+        return {
+            "accum_log_info": dict(self.accum_log_info),
+            "log_size": self.log_checkpointed
+        }
+
+    def commit_checkpoint(self, ckpt_dir: str) -> None:
+        """Called once the checkpoint state written with save_checkpoint() has replaced the previous one (e.g. to delete stale files)."""
+        pass
+
+    def load_checkpoint(self, ckpt_dir: str, state: dict) -> None:
+        """Restore the agent from a checkpoint written by save_checkpoint()."""
+        self.accum_log_info = dict(state["accum_log_info"])
+        # drop the records appended after the checkpoint, and continue the log from there
+        ckpt_log = os.path.join(ckpt_dir, "log.jsonl")
+        self.flush_log()
+        with open(ckpt_log, 'r+b') as f:
+            f.truncate(state["log_size"])
+        shutil.copyfile(ckpt_log, self.log_path)
+        self.log_checkpointed = state["log_size"]
+
     def get_options_text(self, label_set: set[str]) -> str:
         """Convert the label_set into the option text."""
         return '\n'.join(list(label_set))
@@ -1,22 +1,35 @@
 from abc import ABC, abstractmethod
-from typing import Any
-from datasets import load_dataset, Dataset
+from typing import Any, TYPE_CHECKING
+from concurrent.futures import Future
+
+if TYPE_CHECKING:
+    from datasets import Dataset
 
 class Bench(ABC):
     """Associated with corresponding Dataset, Feedback, and Metrics"""
     DATASET_PATH: str = None
     DATASET_NAME: str = None
+    # attributes that hold the streaming progress, saved in checkpoints
+    STATE_KEYS: list[str] = ["n_correct"]
 
     def __init__(self, config: dict):
         self.config = config
+        from datasets import load_dataset  # imported on first use, it is slow to import
         self.dataset = load_dataset(self.DATASET_PATH, self.DATASET_NAME)
         self.use_wandb = False
         self.n_correct = 0
-        self.references = []
-        self.predictions = []
+
+    def state_dict(self) -> dict:
+        """Return the streaming progress of the benchmark, for checkpointing."""
+        return {key: getattr(self, key) for key in self.STATE_KEYS}
+
+    def load_state_dict(self, state: dict) -> None:
+        """Restore the streaming progress returned by state_dict()."""
+        for key in self.STATE_KEYS:
+            setattr(self, key, state[key])
 
     @abstractmethod
-    def get_dataset(self) -> Dataset:
+    def get_dataset(self) -> "Dataset":
         raise NotImplementedError
 
     @abstractmethod
@@ -59,6 +72,19 @@ class Bench(ABC):
         """
         raise NotImplementedError
 
+    def submit_evaluation(self, prediction: Any, label: Any) -> Future:
+        """Start the slow, stateless part of process_results (e.g. executing SQL) in the background.
+
+        The result of the future is passed to process_results as exec_result. The default has nothing to run ahead.
+        """
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def close(self) -> None:
+        """Release what the bench runs in the background (e.g. evaluation workers). Called at the end of the stream."""
+        pass
+
     @abstractmethod
     def process_results(self, prediction: Any, label: Any, return_details: bool = False) -> bool | dict:
         """Compare the prediction with the label and calculate streaming metrics at the current time point.
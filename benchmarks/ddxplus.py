@@ -1,17 +1,23 @@
 import re
-import pandas as pd
 import os
-import evaluate
-from datasets import Dataset
+import csv
+import numpy as np
+from typing import TYPE_CHECKING
 from colorama import Fore, Style
 
 from .base import Bench
+from .metrics import StreamingMetrics
+from .outcomes import OutcomeStore
+
+if TYPE_CHECKING:
+    from datasets import Dataset
 
 class MedicalDiagnosisBench(Bench):
     """A task whose x == patient profile and y == diagnosis."""
     LABEL2TEXT = dict()
     TEXT2LABEL = dict()
     NUM_SHOTS = 16
+    STATE_KEYS = Bench.STATE_KEYS + ["metrics", "outcomes"]
 
     def __init__(
         self,
@@ -20,8 +26,11 @@ class MedicalDiagnosisBench(Bench):
     ) -> None:
         super().__init__({})
         self.split = split
+        # the labels and NOTINLABEL
+        self.metrics = StreamingMetrics(num_classes=len(self.LABEL2TEXT) + 1)
+        self.outcomes = OutcomeStore({"prediction": np.int32, "reference": np.int32})
 
-    def get_dataset(self) -> Dataset:
+    def get_dataset(self) -> "Dataset":
         return self.dataset[self.split]
 
     def get_fewshot_prompt(
@@ -53,9 +62,11 @@ class MedicalDiagnosisBench(Bench):
         return self.TEXT2LABEL[label_text]
 
     def get_metrics(self) -> dict:
-        accuracy = evaluate.load("accuracy")
-        metrics = accuracy.compute(predictions=self.predictions, references=self.references)
-        return metrics        
+        return {
+            "accuracy": self.metrics.accuracy(),
+            "window_accuracy": self.metrics.window_accuracy(),
+            "macro_recall": self.metrics.macro_recall()
+        }
 
     def postprocess_generation(self, res: str, idx: int = -1) -> int:
         number = int(res)
@@ -80,14 +91,15 @@ class MedicalDiagnosisBench(Bench):
         """
         correct = prediction == label
         self.n_correct += correct
-        self.predictions.append(prediction)
-        self.references.append(label)
+        self.outcomes.append(prediction=prediction, reference=label)
+        self.metrics.update(correct, prediction=prediction, label=label)
 
         if return_details:
             return {
                 'correct': int(correct),
                 'n_correct': self.n_correct,
-                'rolling_acc': self.n_correct / len(self.references)
+                'rolling_acc': self.metrics.accuracy(),
+                'window_acc': self.metrics.window_accuracy()
             }
         return correct
 
@@ -106,15 +118,13 @@ class MedicalDiagnosisBench(Bench):
         return f"{label_int}. {label_str}"
 
     def save_output(self, output_path):
-        df = pd.DataFrame({
-            "id": [i for i in range(len(self.predictions))],
-            "result": self.predictions
-        })
-
         # Ensure the parent directory exists
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-        df.to_csv(output_path, index=False)
+        with open(output_path, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["id", "result"])
+            writer.writerows(enumerate(self.outcomes.column("prediction").tolist()))
 
 def create_ddxplus():
     class DDXPlusBench(MedicalDiagnosisBench):
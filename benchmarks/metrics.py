@@ -0,0 +1,67 @@
+import numpy as np
+
+class StreamingMetrics:
+    """Running metrics of a stream, updated in O(1) per time step and readable at any time step.
+
+    Tracks the overall and windowed accuracy, a confusion matrix (and the per-class recall) when
+    num_classes is given, and the accuracy per group (e.g. the db_id of BIRD) when groups are given.
+    """
+    def __init__(self, num_classes: int = None, window: int = 100) -> None:
+        self.num_classes = num_classes
+        self.window = window
+        self.n_total = 0
+        self.n_correct = 0
+        self.recent = np.zeros(window, dtype=bool)  # ring buffer of the correctness of the last steps
+        self.n_recent_correct = 0
+        # confusion[label, prediction]; out-of-range predictions count as the last class
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64) if num_classes else None
+        self.group_index = dict()  # group -> row of group_counts
+        self.group_counts = np.zeros((0, 2), dtype=np.int64)  # [n_total, n_correct] per group
+
+    def update(self, correct: bool, prediction: int = None, label: int = None, group: str = None) -> None:
+        correct = int(correct)
+        slot = self.n_total % self.window
+        # a Python int, so that the count does not overflow the dtype of the ring buffer
+        self.n_recent_correct += correct - int(self.recent[slot])
+        self.recent[slot] = correct
+        self.n_total += 1
+        self.n_correct += correct
+
+        if (self.confusion is not None) and (label is not None):
+            if not (isinstance(prediction, (int, np.integer)) and 0 <= prediction < self.num_classes):
+                prediction = self.num_classes - 1
+            self.confusion[label, prediction] += 1
+
+        if group is not None:
+            if group not in self.group_index:
+                self.group_index[group] = len(self.group_index)
+                if len(self.group_index) > len(self.group_counts):
+                    # grow by doubling, so adding a group is amortized O(1)
+                    grown = np.zeros((max(8, 2 * len(self.group_counts)), 2), dtype=np.int64)
+                    grown[:len(self.group_counts)] = self.group_counts
+                    self.group_counts = grown
+            self.group_counts[self.group_index[group]] += (1, correct)
+
+    def accuracy(self) -> float:
+        return self.n_correct / self.n_total if self.n_total else 0.0
+
+    def window_accuracy(self) -> float:
+        n = min(self.n_total, self.window)
+        return self.n_recent_correct / n if n else 0.0
+
+    def per_class_recall(self) -> np.ndarray:
+        """Recall of each class (NaN for the classes not seen yet)."""
+        support = self.confusion.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.diag(self.confusion) / support
+
+    def macro_recall(self) -> float:
+        recall = self.per_class_recall()
+        seen = ~np.isnan(recall)
+        return float(recall[seen].mean()) if seen.any() else 0.0
+
+    def group_accuracy(self) -> dict:
+        return {
+            group: int(self.group_counts[i, 1]) / int(self.group_counts[i, 0])
+            for group, i in self.group_index.items()
+        }
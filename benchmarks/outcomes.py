@@ -0,0 +1,85 @@
+import os
+import json
+import tempfile
+import numpy as np
+
+class OutcomeStore:
+    """Outcomes of the time steps of a stream, kept in NumPy columns that grow by doubling.
+
+    Text values (e.g. the predicted SQL) are not kept in memory: they are appended to a spill file
+    as one JSON line per step, and the `spill_offset` column holds where each line starts.
+    Pickling the store (e.g. in a checkpoint) records the size of the spill file, and unpickling
+    truncates the file back to it. Without a spill_path, the spill file is a temporary file that close() deletes.
+    """
+    def __init__(self, columns: dict, text_columns: list[str] = (), spill_path: str = None) -> None:
+        self.columns = {name: np.zeros(0, dtype=dtype) for name, dtype in columns.items()}
+        self.text_columns = list(text_columns)
+        if self.text_columns:
+            self.columns["spill_offset"] = np.zeros(0, dtype=np.int64)
+        self.temporary = bool(self.text_columns) and (spill_path is None)
+        if self.temporary:
+            fd, spill_path = tempfile.mkstemp(suffix=".jsonl")
+            os.close(fd)
+        self.spill_path = spill_path
+        self.spill = None  # opened on the first append, so that resuming does not truncate it
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, **values) -> None:
+        if self.size == len(self.columns[next(iter(self.columns))]):
+            capacity = max(1024, 2 * self.size)
+            for name, array in self.columns.items():
+                grown = np.zeros(capacity, dtype=array.dtype)
+                grown[:self.size] = array[:self.size]
+                self.columns[name] = grown
+        if self.text_columns:
+            if self.spill is None:
+                if os.path.dirname(self.spill_path):
+                    os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+                self.spill = open(self.spill_path, "wb")
+            self.columns["spill_offset"][self.size] = self.spill.tell()
+            line = json.dumps({name: values.pop(name) for name in self.text_columns}) + "\n"
+            self.spill.write(line.encode())
+        for name, value in values.items():
+            self.columns[name][self.size] = value
+        self.size += 1
+
+    def column(self, name: str) -> np.ndarray:
+        return self.columns[name][:self.size]
+
+    def text(self, index: int) -> dict:
+        """Read back the text values of a step from the spill file."""
+        if self.spill is not None:
+            self.spill.flush()
+        with open(self.spill_path, "rb") as f:
+            f.seek(int(self.columns["spill_offset"][index]))
+            return json.loads(f.readline())
+
+    def __getstate__(self) -> dict:
+        state = dict(self.__dict__)
+        state["columns"] = {name: array[:self.size].copy() for name, array in self.columns.items()}
+        state["spill"] = None
+        state["spill_size"] = 0
+        if self.spill is not None:
+            self.spill.flush()
+            state["spill_size"] = self.spill.tell()
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        spill_size = state.pop("spill_size")
+        self.__dict__.update(state)
+        if self.text_columns and os.path.exists(self.spill_path):
+            # drop the lines written after the state was saved, and continue from there
+            self.spill = open(self.spill_path, "r+b")
+            self.spill.truncate(spill_size)
+            self.spill.seek(spill_size)
+
+    def close(self) -> None:
+        """Close the spill file, and delete it if it was a temporary file."""
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        if self.temporary and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
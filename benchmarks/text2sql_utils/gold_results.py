@@ -0,0 +1,54 @@
+import os
+import json
+import hashlib
+
+def db_fingerprint(db_path: str) -> str:
+    """Cheap identity of a database file: its size, mtime and a hash of its header page."""
+    stat = os.stat(db_path)
+    with open(db_path, "rb") as f:
+        header = f.read(4096)
+    return f"{stat.st_size}-{stat.st_mtime_ns}-{hashlib.sha1(header).hexdigest()[:16]}"
+
+class GoldResultStore:
+    """Results of the ground-truth SQL, keyed by question_id and database fingerprint.
+
+    Only the fingerprint and the number of distinct rows of each result set are kept, which is all
+    `execute_model` needs to grade a prediction without running the gold query again.
+    """
+    VERSION = 2
+
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self.entries = dict()  # "question_id:db fingerprint" -> {"digest": str, "n_rows": int}
+        self.fingerprints = dict()  # db_path -> db fingerprint
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def key(self, question_id, db_path: str) -> str:
+        if db_path not in self.fingerprints:
+            # a missing database is reported by execute_model, not here
+            self.fingerprints[db_path] = db_fingerprint(db_path) if os.path.exists(db_path) else "missing"
+        return f"{question_id}:{self.fingerprints[db_path]}"
+
+    def get(self, question_id, db_path: str) -> dict:
+        return self.entries.get(self.key(question_id, db_path))
+
+    def put(self, question_id, db_path: str, gold: dict) -> None:
+        self.entries[self.key(question_id, db_path)] = {"digest": gold["digest"], "n_rows": gold["n_rows"]}
+
+    def load(self, path: str) -> None:
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != self.VERSION:
+            print(f"Ignoring gold results in {path}: version {data.get('version')} != {self.VERSION}")
+            return
+        self.entries = data["entries"]
+
+    def save(self, path: str = None) -> None:
+        path = path or self.path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.VERSION, "entries": self.entries}, f)
+        os.replace(tmp_path, path)
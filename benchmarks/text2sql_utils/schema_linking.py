@@ -0,0 +1,125 @@
+import re
+from .sqlite_interpreter import get_connection_pool
+
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "from", "by", "with", "and", "or", "not",
+    "is", "are", "was", "were", "be", "been", "do", "does", "did", "has", "have", "had",
+    "what", "which", "who", "whom", "whose", "when", "where", "how", "many", "much",
+    "that", "this", "these", "those", "it", "its", "their", "there", "as", "than", "please",
+    "list", "give", "show", "find", "all", "any", "each", "among"
+}
+
+def split_words(text: str) -> set[str]:
+    """Lowercased words of a question or an identifier (snake_case, camelCase and spaces are split), singularized."""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+    words = set()
+    for word in re.split(r"[^0-9a-zA-Z]+", text.lower()):
+        if (not word) or (word in STOPWORDS):
+            continue
+        if (len(word) > 3) and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.add(word)
+    return words
+
+def quote(name: str) -> str:
+    """Quote an identifier, so that reserved words (e.g. the `order` table of BIRD's financial database) stay names."""
+    return '"' + name.replace('"', '""') + '"'
+
+class SchemaLinker:
+    """Prunes the schema prompt of a database down to the tables and columns a question mentions.
+
+    Tables and columns are matched lexically against the words of the question, the words of the table name
+    being left out of its column names (BIRD keys repeat it, e.g. `client.client_id`), and the tables the
+    linked tables reference are added for the joins. The prompt must fit in `token_budget`, approximated as
+    4 characters per token: tables are added by decreasing relevance in their pruned form (the keys, plus the
+    matched columns of a table whose name did not match), then given back all their columns, in the same
+    order, while the prompt still fits. Columns are thus only pruned when the whole tables do not fit.
+    """
+    def __init__(self, token_budget: int = 1024) -> None:
+        self.token_budget = token_budget
+        self.indexes = dict()  # db_path -> list of tables, indexed once per database
+
+    def index(self, db_path: str) -> list[dict]:
+        if db_path in self.indexes:
+            return self.indexes[db_path]
+        tables = []
+        with get_connection_pool().connection(db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != 'sqlite_sequence'")
+            for (name,) in cursor.fetchall():
+                # cid, name, type, notnull, dflt_value, pk
+                columns = cursor.execute(f"PRAGMA table_info({quote(name)})").fetchall()
+                # id, seq, table, from, to, on_update, on_delete, match
+                foreign_keys = cursor.execute(f"PRAGMA foreign_key_list({quote(name)})").fetchall()
+                tables.append({
+                    "name": name,
+                    "words": split_words(name),
+                    "columns": [
+                        {"name": col[1], "type": col[2], "pk": col[5], "words": split_words(col[1])}
+                        for col in columns
+                    ],
+                    "foreign_keys": [(fk[3], fk[2], fk[4]) for fk in foreign_keys]
+                })
+        self.indexes[db_path] = tables
+        return tables
+
+    def render_table(self, table: dict, column_names: set[str]) -> str:
+        lines = [
+            f"    {quote(col['name'])} {col['type']}".rstrip()
+            for col in table["columns"] if col["name"] in column_names
+        ]
+        primary_key = [quote(col["name"]) for col in sorted(table["columns"], key=lambda col: col["pk"]) if col["pk"]]
+        if primary_key:
+            lines.append(f"    PRIMARY KEY ({', '.join(primary_key)})")
+        for from_column, ref_table, to_column in table["foreign_keys"]:
+            if from_column in column_names:
+                reference = f"{quote(ref_table)}({quote(to_column)})" if to_column else quote(ref_table)
+                lines.append(f"    FOREIGN KEY ({quote(from_column)}) REFERENCES {reference}")
+        return f"CREATE TABLE {quote(table['name'])}\n(\n" + ",\n".join(lines) + "\n)"
+
+    def link(self, db_path: str, question: str) -> str | None:
+        """Return the pruned schema prompt for the question, or None when nothing in the schema matches it."""
+        question_words = split_words(question)
+        linked = []
+        tables = self.index(db_path)
+        for order, table in enumerate(tables):
+            matched = [col for col in table["columns"] if (col["words"] - table["words"]) & question_words]
+            table_match = len(table["words"] & question_words)
+            score = 2 * table_match + len(matched)
+            if score == 0:
+                continue
+            if table_match:
+                pruned = {col["name"] for col in table["columns"]}
+            else:
+                pruned = {col["name"] for col in matched}
+                pruned |= {col["name"] for col in table["columns"] if col["pk"]}
+                pruned |= {from_column for from_column, _, _ in table["foreign_keys"]}
+            linked.append((-score, order, table, pruned))
+        if not linked:
+            return None
+
+        # the tables the linked tables reference are needed for the joins, pruned to their keys
+        linked_names = {table["name"] for _, _, table, _ in linked}
+        referenced = {ref_table for _, _, table, _ in linked for _, ref_table, _ in table["foreign_keys"]}
+        for order, table in enumerate(tables):
+            if (table["name"] in referenced) and (table["name"] not in linked_names):
+                column_names = {col["name"] for col in table["columns"] if col["pk"]}
+                column_names |= {from_column for from_column, _, _ in table["foreign_keys"]}
+                linked.append((0, order, table, column_names))
+
+        # the most relevant tables first, then keep the order of the database
+        linked.sort(key=lambda item: item[:2])
+        max_chars = 4 * self.token_budget
+        selected, num_chars = [], 0  # (order, table, prompt of the table)
+        for _, order, table, column_names in linked:
+            table_prompt = self.render_table(table, column_names)
+            if (not selected) or (num_chars + len(table_prompt) <= max_chars):
+                selected.append((order, table, table_prompt))
+                num_chars += len(table_prompt) + 2
+        # then the selected tables get all their columns back while the prompt fits
+        for i, (order, table, table_prompt) in enumerate(selected):
+            full_prompt = self.render_table(table, {col["name"] for col in table["columns"]})
+            if num_chars - len(table_prompt) + len(full_prompt) <= max_chars:
+                selected[i] = (order, table, full_prompt)
+                num_chars += len(full_prompt) - len(table_prompt)
+        return "\n\n".join(table_prompt for _, _, table_prompt in sorted(selected, key=lambda item: item[0]))
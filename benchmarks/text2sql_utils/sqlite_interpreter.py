@@ -1,66 +1,411 @@
+import os
 import sys
+import time
+import atexit
+import hashlib
 import sqlite3
-from func_timeout import func_timeout, FunctionTimedOut
+import resource
+import threading
+import multiprocessing
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
-def execute_sql(predicted_sql, ground_truth, db_path, show_num_rows=10):
-    conn = sqlite3.connect(db_path)
-    # Connect to the database
+# number of SQLite VM instructions between two checks of the query budget
+PROGRESS_INTERVAL = 1000
+# number of rows fetched at a time when comparing results
+FETCH_SIZE = 1000
+
+class QueryTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """Read-only SQLite connections keyed by db_path, reused across steps and threads.
+
+    A connection is handed to one thread at a time, and goes back to the pool when the thread is done with it.
+    With a memory budget, the most recently used databases that fit in it are copied into shared in-memory
+    databases with the backup API, and their connections read the copy instead of the file.
+    """
+    def __init__(self, cache_size_kib: int = 65536, mmap_size: int = 256 * 1024 * 1024, memory_budget_mb: int = 0):
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)  # uri -> idle connections
+        self.closed = False
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.resident = OrderedDict()  # db_path -> (uri of the in-memory copy, connection keeping it alive, size in bytes)
+        self.memory_used = 0
+        self.num_loaded = 0
+        self.load_lock = threading.Lock()  # one copy is loaded at a time
+
+    def disk_uri(self, db_path: str) -> str:
+        # the evaluation databases never change, so they are opened read-only and immutable
+        return f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro&immutable=1"
+
+    def connect(self, uri: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        # also rejects TEMP tables and views, which would outlive the query on a pooled connection
+        conn.execute("PRAGMA query_only = 1")
+        if "mode=memory" not in uri:
+            conn.execute(f"PRAGMA cache_size = -{self.cache_size_kib}")
+            conn.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+        return conn
+
+    @staticmethod
+    def is_pristine(conn: sqlite3.Connection) -> bool:
+        """Whether the queries run on conn left nothing behind for the next ones (no writable mode, TEMP objects or attached databases)."""
+        try:
+            return (
+                conn.execute("PRAGMA query_only").fetchone()[0] == 1
+                and conn.execute("SELECT COUNT(*) FROM temp.sqlite_master").fetchone()[0] == 0
+                and len(conn.execute("PRAGMA database_list").fetchall()) == 2
+            )
+        except sqlite3.Error:
+            return False
+
+    def set_memory_budget(self, memory_budget_mb: int) -> None:
+        with self.lock:
+            self.memory_budget = memory_budget_mb * 1024 * 1024
+            self.evict(0)
+
+    def evict(self, size: int) -> None:
+        """Drop the least recently used in-memory copies until `size` more bytes fit in the budget. Called with the lock held."""
+        while self.resident and (self.memory_used + size > self.memory_budget):
+            _, (uri, keeper, db_size) = self.resident.popitem(last=False)
+            # connections in use are closed when they are released
+            for conn in self.idle.pop(uri, []):
+                conn.close()
+            keeper.close()
+            self.memory_used -= db_size
+
+    def is_resident(self, uri: str) -> bool:
+        return any(entry[0] == uri for entry in self.resident.values())
+
+    def resolve(self, db_path: str) -> str:
+        """Return the URI to read db_path from: its in-memory copy (loaded on first use) if it fits in the memory budget, else the file."""
+        if (self.memory_budget <= 0) or not os.path.exists(db_path):
+            return self.disk_uri(db_path)
+        with self.lock:
+            if db_path in self.resident:
+                self.resident.move_to_end(db_path)
+                return self.resident[db_path][0]
+        size = os.path.getsize(db_path)
+        if size > self.memory_budget:
+            return self.disk_uri(db_path)
+
+        with self.load_lock:
+            with self.lock:
+                if db_path in self.resident:
+                    # loaded by another thread in the meantime
+                    self.resident.move_to_end(db_path)
+                    return self.resident[db_path][0]
+                self.evict(size)
+                self.memory_used += size
+                self.num_loaded += 1
+                uri = f"file:streambench-db-{self.num_loaded}?mode=memory&cache=shared"
+            keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            source = sqlite3.connect(self.disk_uri(db_path), uri=True)
+            try:
+                source.backup(keeper)
+            except sqlite3.Error:
+                keeper.close()
+                with self.lock:
+                    self.memory_used -= size
+                return self.disk_uri(db_path)
+            finally:
+                source.close()
+            with self.lock:
+                self.resident[db_path] = (uri, keeper, size)
+        return uri
+
+    @contextmanager
+    def connection(self, db_path: str):
+        uri = self.resolve(db_path)
+        with self.lock:
+            conn = self.idle[uri].pop() if self.idle[uri] else None
+        if conn is None:
+            conn = self.connect(uri)
+        try:
+            yield conn
+        finally:
+            pristine = self.is_pristine(conn)
+            with self.lock:
+                if self.closed or (not pristine) or (("mode=memory" in uri) and not self.is_resident(uri)):
+                    conn.close()
+                else:
+                    self.idle[uri].append(conn)
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+            for _, keeper, _ in self.resident.values():
+                keeper.close()
+            self.resident.clear()
+            self.memory_used = 0
+
+_POOL = ConnectionPool()
+atexit.register(_POOL.close)
+
+def get_connection_pool() -> ConnectionPool:
+    return _POOL
+
+def set_memory_budget(memory_budget_mb: int) -> None:
+    """Set the memory budget of the connection pool of this process (also used to initialize worker processes)."""
+    _POOL.set_memory_budget(memory_budget_mb)
+
+@contextmanager
+def query_budget(conn: sqlite3.Connection, time_out: float, max_vm_steps: int = None):
+    """Interrupt the statements run on `conn` once they exceed `time_out` seconds or `max_vm_steps` VM instructions."""
+    deadline = time.monotonic() + time_out
+    state = {"steps": 0, "reason": None}
+
+    def handler():
+        state["steps"] += PROGRESS_INTERVAL
+        if time.monotonic() > deadline:
+            state["reason"] = "Database execution timeout"
+        elif max_vm_steps is not None and state["steps"] > max_vm_steps:
+            state["reason"] = "Database execution exceeded the VM step budget"
+        return state["reason"] is not None
+
+    conn.set_progress_handler(handler, PROGRESS_INTERVAL)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if state["reason"] is not None:
+            raise QueryTimeout(state["reason"]) from e
+        raise
+    finally:
+        # pooled connections are shared, so the budget must not outlive this query
+        conn.set_progress_handler(None, PROGRESS_INTERVAL)
+
+def normalize_value(val):
+    if isinstance(val, float) and val.is_integer():
+        return int(val)
+    return val
+
+class ResultFingerprint:
+    """Order-insensitive fingerprint of the distinct rows of a result, built while the rows are fetched.
+
+    Each distinct row adds the md5 of its normalized repr modulo 2**128, so no sort is needed, and two
+    results have the same fingerprint iff they are equal as sets (with 1 == 1.0, as in Python).
+    With keep_text, the repr of the distinct rows is also kept for legacy_hexdigest().
+    """
+    def __init__(self, keep_text: bool = False) -> None:
+        self.seen = set()  # md5 of the distinct rows
+        self.total = 0
+        self.texts = [] if keep_text else None  # repr of the distinct rows
+
+    def update(self, rows) -> None:
+        for row in rows:
+            text = repr(tuple(normalize_value(v) for v in row))
+            h = hashlib.md5(text.encode()).digest()
+            if h not in self.seen:
+                self.seen.add(h)
+                self.total = (self.total + int.from_bytes(h, "big")) % (1 << 128)
+                if self.texts is not None:
+                    self.texts.append(text)
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.seen)
+
+    def hexdigest(self) -> str:
+        return f"{self.total:032x}"
+
+    def legacy_hexdigest(self) -> str:
+        """md5 of the sorted distinct rows joined by '||', the hash the Kaggle reference results were built with."""
+        return hashlib.md5("||".join(sorted(self.texts)).encode()).hexdigest()
+
+def fetch_result(cursor, sql, keep_rows=None, max_distinct=None, keep_text=False):
+    """Run `sql` and fingerprint its rows FETCH_SIZE at a time.
+
+    Keep the first `keep_rows` rows (all if None), and stop fetching once the result has more than `max_distinct` distinct rows.
+    """
+    cursor.execute(sql)
+    fingerprint = ResultFingerprint(keep_text=keep_text)
+    rows = []
+    while True:
+        chunk = cursor.fetchmany(FETCH_SIZE)
+        if not chunk:
+            break
+        fingerprint.update(chunk)
+        if keep_rows is None:
+            rows.extend(chunk)
+        elif len(rows) < keep_rows:
+            rows.extend(chunk[:keep_rows - len(rows)])
+        if (max_distinct is not None) and (fingerprint.n_rows > max_distinct):
+            break
+    return rows, fingerprint
+
+def render_md_table(rows, show_num_rows=10) -> str:
+    if not rows:
+        return ''
+    md_table = "| " + " | ".join(["Column{}".format(i + 1) for i in range(len(rows[0]))]) + " |\n"
+    md_table += "| " + " | ".join(["---" for _ in range(len(rows[0]))]) + " |\n"
+    for row in rows[:show_num_rows]:
+        md_table += "| " + " | ".join(map(str, row)) + " |\n"
+    return md_table
+
+def execute_sql(predicted_sql, ground_truth, db_path, show_num_rows=10, gold=None, time_out=30, max_vm_steps=None, max_extra_rows=1000, render_tables=False, legacy_hash=False):
+    with get_connection_pool().connection(db_path) as conn:
+        with query_budget(conn, time_out, max_vm_steps):
+            return _execute_sql(conn, predicted_sql, ground_truth, show_num_rows, gold, max_extra_rows, render_tables, legacy_hash)
+
+def _execute_sql(conn, predicted_sql, ground_truth, show_num_rows, gold=None, max_extra_rows=1000, render_tables=False, legacy_hash=False):
     cursor = conn.cursor()
-    cursor.execute(predicted_sql)
-    predicted_res = cursor.fetchall()
-    pred_md_table = "| " + " | ".join(["Column{}".format(i + 1) for i in range(len(predicted_res[0]))]) + " |\n"
-    pred_md_table += "| " + " | ".join(["---" for _ in range(len(predicted_res[0]))]) + " |\n"
-    for row in predicted_res[:show_num_rows]:
-        pred_md_table += "| " + " | ".join(map(str, row)) + " |\n"
-    cursor.execute(ground_truth)
-    ground_truth_res = cursor.fetchall()
-
-    gt_md_table = "| " + " | ".join(["Column{}".format(i + 1) for i in range(len(ground_truth_res[0]))]) + " |\n"
-    gt_md_table += "| " + " | ".join(["---" for _ in range(len(ground_truth_res[0]))]) + " |\n"
-    for row in ground_truth_res[:show_num_rows]:
-        gt_md_table += "| " + " | ".join(map(str, row)) + " |\n"
-    res = 0
-    if set(predicted_res) == set(ground_truth_res):
-        res = 1
-    
+    ground_truth_res = ''
+    gold_executed = gold is None
+    if gold_executed:
+        # the gold query runs first, so that its size bounds the fetch of the prediction
+        ground_truth_res, gt_fingerprint = fetch_result(cursor, ground_truth, keep_rows=show_num_rows if render_tables else 0)
+        gold = {"digest": gt_fingerprint.hexdigest(), "n_rows": gt_fingerprint.n_rows}
+
+    # a prediction with more distinct rows than the gold is already wrong
+    max_distinct = gold["n_rows"] + max_extra_rows if max_extra_rows is not None else None
+    predicted_res, pred_fingerprint = fetch_result(
+        cursor, predicted_sql,
+        keep_rows=show_num_rows if render_tables else 0,
+        max_distinct=max_distinct,
+        keep_text=legacy_hash
+    )
+    res = int(pred_fingerprint.hexdigest() == gold["digest"])
+
     return {
         "res": res, 
         "predicted_res": predicted_res,
+        "predicted_digest": pred_fingerprint.hexdigest(),
+        "predicted_hash": pred_fingerprint.legacy_hexdigest() if legacy_hash else None,
         "ground_truth_res": ground_truth_res,
-        "pred_md_table": pred_md_table, 
-        "gt_md_table": gt_md_table
+        "pred_md_table": render_md_table(predicted_res, show_num_rows) if render_tables else '', 
+        "gt_md_table": render_md_table(ground_truth_res, show_num_rows) if render_tables else '',
+        "gold": gold if gold_executed else None
     }
 
-def execute_model(predicted_sql, ground_truth, db_path, meta_time_out=30):
+def validate_sql(sql, db_path) -> str | None:
+    """Compile `sql` without running it, and return the error SQLite would raise for it (None if it is valid)."""
+    with get_connection_pool().connection(db_path) as conn:
+        try:
+            conn.execute("EXPLAIN " + sql).close()
+        except Exception as e:
+            return str(e)
+    return None
+
+def _sandbox_worker(conn, memory_mb: int, cpu_seconds: int) -> None:
+    if memory_mb:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024, hard))
+    while True:
+        try:
+            args, kwargs = conn.recv()
+        except EOFError:
+            return
+        if cpu_seconds:
+            # RLIMIT_CPU counts the whole life of the worker, so move the limit past the time used so far
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + cpu_seconds, hard))
+        try:
+            out = execute_sql(*args, **kwargs)
+        except Exception as e:
+            out = e
+        try:
+            conn.send(out)
+        except Exception as e:
+            conn.send(RuntimeError(f"Cannot send the query result back: {e}"))
+
+class SandboxExecutor:
+    """Runs execute_sql in a worker process with memory and CPU limits.
+
+    The worker is persistent, and is killed and restarted when a query overruns its limits
+    or does not answer within its time out plus `grace_seconds`.
+    """
+    def __init__(self, memory_mb: int = 2048, cpu_seconds: int = 60, grace_seconds: float = 5):
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.grace_seconds = grace_seconds
+        # spawn, so that the worker does not inherit the address space of the model process
+        self.ctx = multiprocessing.get_context("spawn")
+        self.lock = threading.Lock()
+        self.process = None
+        self.conn = None
+
+    def start(self) -> None:
+        parent_conn, child_conn = self.ctx.Pipe()
+        self.process = self.ctx.Process(
+            target=_sandbox_worker,
+            args=(child_conn, self.memory_mb, self.cpu_seconds),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+            self.conn.close()
+            self.process = None
+            self.conn = None
+
+    def run(self, predicted_sql, ground_truth, db_path, time_out=30, **kwargs) -> dict:
+        with self.lock:
+            if self.process is None or not self.process.is_alive():
+                self.start()
+            self.conn.send(((predicted_sql, ground_truth, db_path), {"time_out": time_out, **kwargs}))
+            try:
+                if not self.conn.poll(time_out + self.grace_seconds):
+                    self.stop()
+                    raise QueryTimeout("Database execution timeout")
+                out = self.conn.recv()
+            except EOFError:
+                # the worker was killed by one of its resource limits
+                self.stop()
+                raise RuntimeError("Database execution exceeded the sandbox resource limits")
+        if isinstance(out, Exception):
+            raise out
+        return out
+
+def execute_model(predicted_sql, ground_truth, db_path, meta_time_out=30, gold=None, max_vm_steps=None, max_extra_rows=1000, render_tables=False, legacy_hash=False, sandbox: SandboxExecutor = None):
     # Initialize results
     result = {
         "res": 0,
         "predicted_res": '',
+        "predicted_digest": None,
+        "predicted_hash": None,
         "ground_truth_res": '',
         "pred_md_table": '',
-        "gt_md_table": ''
+        "gt_md_table": '',
+        "gold": None
     }
 
     try:
         # Execute SQL with timeout
-        res_dict = func_timeout(
-            meta_time_out, execute_sql,
-            args=(predicted_sql, ground_truth, db_path)
+        run = sandbox.run if sandbox is not None else execute_sql
+        res_dict = run(
+            predicted_sql, ground_truth, db_path,
+            gold=gold, time_out=meta_time_out, max_vm_steps=max_vm_steps,
+            max_extra_rows=max_extra_rows, render_tables=render_tables, legacy_hash=legacy_hash
         )
         
         # Update result dictionary with returned values
         result.update({
             "res": res_dict.get('res', 0),
             "predicted_res": res_dict.get('predicted_res', ''),
+            "predicted_digest": res_dict.get('predicted_digest'),
+            "predicted_hash": res_dict.get('predicted_hash'),
             "ground_truth_res": res_dict.get('ground_truth_res', ''),
             "pred_md_table": res_dict.get('pred_md_table', ''),
-            "gt_md_table": res_dict.get('gt_md_table', '')
+            "gt_md_table": res_dict.get('gt_md_table', ''),
+            "gold": res_dict.get('gold')
         })
         
     except KeyboardInterrupt:
         sys.exit(0)
-    except FunctionTimedOut:
-        result["predicted_res"] = 'Database execution timeout'
     except Exception as e:
         result["predicted_res"] = str(e)
     
@@ -1,5 +1,5 @@
 import re
-import sqlite3
+from .sqlite_interpreter import get_connection_pool
 
 def nice_look_table(column_names: list, values: list):
     rows = []
@@ -50,20 +50,17 @@ def generate_schema_prompt(db_path, num_rows=None):
     :return:
     '''
     full_schema_prompt_list = []
-    with sqlite3.connect(db_path) as conn:
+    with get_connection_pool().connection(db_path) as conn:
         # Create a cursor object
         cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        # one scan of sqlite_master for the DDL of all tables
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table'")
         tables = cursor.fetchall()
         schemas = {}
-        for table in tables:
-            if table == 'sqlite_sequence':
-                continue
-            cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='{}';".format(table[0]))
-            create_prompt = cursor.fetchone()[0]
-            schemas[table[0]] = create_prompt
+        for table, create_prompt in tables:
+            schemas[table] = create_prompt
             if num_rows:
-                cur_table = table[0]
+                cur_table = table
                 if cur_table in ['order', 'by', 'group']:
                     cur_table = "`{}`".format(cur_table)
 
@@ -72,7 +69,7 @@ def generate_schema_prompt(db_path, num_rows=None):
                 values = cursor.fetchall()
                 rows_prompt = nice_look_table(column_names=column_names, values=values)
                 verbose_prompt = "/* \n {} example rows: \n SELECT * FROM {} LIMIT {}; \n {} \n */".format(num_rows, cur_table, num_rows, rows_prompt)
-                schemas[table[0]] = "{} \n {}".format(create_prompt, verbose_prompt)
+                schemas[table] = "{} \n {}".format(create_prompt, verbose_prompt)
 
     for v in schemas.values():
         full_schema_prompt_list.append(v)
@@ -1,59 +1,132 @@
 import os
+import csv
+import json
 import hashlib
-import pandas as pd
-from tqdm import tqdm
-from datasets import Dataset
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from typing import TYPE_CHECKING
 from colorama import Fore, Style
 from .base import Bench
-from .text2sql_utils.sqlite_interpreter import execute_model
+from .metrics import StreamingMetrics
+from .outcomes import OutcomeStore
+from .text2sql_utils.sqlite_interpreter import execute_model, validate_sql, set_memory_budget, SandboxExecutor
+from .text2sql_utils.gold_results import GoldResultStore, db_fingerprint
 from .text2sql_utils.string_formatter import generate_schema_prompt
+from .text2sql_utils.schema_linking import SchemaLinker
+
+if TYPE_CHECKING:
+    from datasets import Dataset
 
 def create_bird():
     class StreamingBird(GeneralText2SQL):
         DATASET_PATH = 'appier-ai-research/StreamBench_public'
         DATASET_NAME = 'bird'
-        def __init__(self, db_path='data/bird/dev_databases', **kwargs):
-            super().__init__(db_path=db_path, **kwargs)
+        def __init__(self, db_path='data/bird/dev_databases', gold_results_path='data/bird/gold_results.json', schema_cache_path='data/bird/schema_prompts.json', **kwargs):
+            super().__init__(db_path=db_path, gold_results_path=gold_results_path, schema_cache_path=schema_cache_path, **kwargs)
     return StreamingBird
 
 def create_bird_private():
     class StreamingBird(GeneralText2SQL):
         DATASET_PATH = 'appier-ai-research/StreamBench_private_final'
         DATASET_NAME = 'bird'
-        def __init__(self, db_path='data/bird_private/train_databases', **kwargs):
-            super().__init__(db_path=db_path, **kwargs)
+        def __init__(self, db_path='data/bird_private/train_databases', gold_results_path='data/bird_private/gold_results.json', schema_cache_path='data/bird_private/schema_prompts.json', **kwargs):
+            super().__init__(db_path=db_path, gold_results_path=gold_results_path, schema_cache_path=schema_cache_path, **kwargs)
     return StreamingBird
 
 class GeneralText2SQL(Bench):
     """A task represents an entire benchmark including its dataset, problems,
     answers, generation settings and evaluation methods.
     """
+    STATE_KEYS = Bench.STATE_KEYS + ["total", "metrics", "outcomes", "db_ids"]
+
     def __init__(
         self,
         split: str = "test",
         db_path: str = None,
+        gold_results_path: str = None,
+        schema_cache_path: str = None,
+        schema_linking: bool = False,
+        schema_token_budget: int = 1024,
+        sql_timeout: float = 30,
+        sql_max_vm_steps: int = None,
+        sql_max_extra_rows: int = 1000,
+        sql_sandbox: bool = False,
+        sql_memory_budget_mb: int = 0,
+        sql_submission_hash: str = "legacy",
+        eval_workers: int = 4,
         **kwargs
     ) -> None:
         super().__init__(config={})
         self.split = split
         self.db_path = db_path
+        self.schema_cache_path = schema_cache_path
+        # prune the schema of each prompt down to the tables and columns the question mentions
+        self.schema_linker = SchemaLinker(token_budget=schema_token_budget) if schema_linking else None
+        # precomputed with `python test_env.py --save_gold_results`
+        self.gold_store = GoldResultStore(gold_results_path)
+        self.sql_timeout = sql_timeout
+        self.sql_max_vm_steps = sql_max_vm_steps
+        self.sql_max_extra_rows = sql_max_extra_rows
+        # legacy: md5 of the sorted rows, as in the Kaggle references; fingerprint: ResultFingerprint.hexdigest()
+        assert sql_submission_hash in ["legacy", "fingerprint"]
+        self.sql_submission_hash = sql_submission_hash
+        self.sandbox = SandboxExecutor() if sql_sandbox else None
+        # keep the most recently used databases in memory; the budget covers all the processes of the bench,
+        # and is split across the evaluation workers once they start (see submit_evaluation)
+        self.sql_memory_budget_mb = sql_memory_budget_mb
+        set_memory_budget(sql_memory_budget_mb)
+        self.eval_workers = eval_workers
+        self.eval_executor = None  # created on the first submit_evaluation
+        self.sql_errors = dict()  # (db_id, normalized SQL) -> compile error, None for valid SQL
         self.total = 0
+        self.metrics = StreamingMetrics()
         self.eval_set = self.dataset[self.split]
         self.initialize()
-        self.sql_results = []
+        # per-step outcomes; the predicted SQL is spilled next to the output file
+        output_path = kwargs.get("output_path")
+        self.outcomes = OutcomeStore(
+            {"question_id": np.int64, "db": np.int32, "correct": np.int8, "result": "S32"},
+            text_columns=["sql"],
+            spill_path=os.path.splitext(output_path)[0] + "_predictions.jsonl" if output_path else None
+        )
+        self.db_ids = dict()  # db_id -> id in the "db" column
 
-    def get_dataset(self) -> Dataset:
+    def get_dataset(self) -> "Dataset":
         """Returns dataset for the task or an iterable of any object, that get_prompt can handle"""
         return self.eval_set
 
     def initialize(self) -> None:
         # print("Initializing DB schema prompts...")
+        # db_id -> {"fingerprint": fingerprint of the .sqlite file, "prompt": schema prompt}
+        schema_cache = dict()
+        if self.schema_cache_path and os.path.exists(self.schema_cache_path):
+            with open(self.schema_cache_path) as f:
+                schema_cache = json.load(f)
+
         self.db_prompt_schema = dict()
-        for row in tqdm(self.eval_set, dynamic_ncols=True):
-            if row["db_id"] not in self.db_prompt_schema:
-                db_path = os.path.join(self.db_path, row["db_id"], row["db_id"] + ".sqlite")
-                schema_prompt = generate_schema_prompt(db_path)
-                self.db_prompt_schema[row["db_id"]] = schema_prompt
+        missing = []
+        for db_id in self.eval_set.unique("db_id"):
+            fingerprint = db_fingerprint(self.get_db_file(db_id))
+            entry = schema_cache.get(db_id)
+            if (entry is not None) and (entry["fingerprint"] == fingerprint):
+                self.db_prompt_schema[db_id] = entry["prompt"]
+            else:
+                missing.append((db_id, fingerprint))
+        if not missing:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(8, len(missing))) as pool:
+            prompts = pool.map(lambda item: generate_schema_prompt(self.get_db_file(item[0])), missing)
+            for (db_id, fingerprint), schema_prompt in zip(missing, prompts):
+                self.db_prompt_schema[db_id] = schema_prompt
+                schema_cache[db_id] = {"fingerprint": fingerprint, "prompt": schema_prompt}
+        if self.schema_cache_path:
+            if os.path.dirname(self.schema_cache_path):
+                os.makedirs(os.path.dirname(self.schema_cache_path), exist_ok=True)
+            with open(self.schema_cache_path + ".tmp", 'w') as f:
+                json.dump(schema_cache, f)
+            os.replace(self.schema_cache_path + ".tmp", self.schema_cache_path)
 
     def postprocess_generation(self, generation: str, idx: int = -1) -> str:
         """Defines the postprocessing for a LM generation.
@@ -63,21 +136,30 @@ class GeneralText2SQL(Bench):
             index of doc in the dataset to which the generation belongs
             (not used for GeneralText2SQL-Task)
         """
-        # TODO: check if the SQL is valid, if not then notify the user
-        if not self.check_sql_validity(generation):
-            print(Fore.RED + f"Invalid SQL: {generation}" + Style.RESET_ALL)
+        # the SQL is checked in process_results, where its database is known
         return generation
 
-    def check_sql_validity(self, sql_code: str) -> bool:
+    def get_sql_error(self, sql_code: str, db_id: str) -> str | None:
+        """
+        Compile the SQL against its database without running it, and return the error if it is invalid.
+        """
+        key = (db_id, " ".join(sql_code.split()))
+        if key not in self.sql_errors:
+            self.sql_errors[key] = validate_sql(sql_code, self.get_db_file(db_id))
+        return self.sql_errors[key]
+
+    def check_sql_validity(self, sql_code: str, db_id: str) -> bool:
         """
         Check if the given SQL code is valid.
         """
-        # TODO
-        return True
+        return self.get_sql_error(sql_code, db_id) is None
 
     def get_input(self, row: dict) -> dict:
         schema = self.db_prompt_schema[row["db_id"]]
         question = row["question"]
+        if self.schema_linker is not None:
+            # fall back to the full schema when nothing in it matches the question
+            schema = self.schema_linker.link(self.get_db_file(row["db_id"]), question) or schema
         return {"table_schema": schema, "user_query": question}
 
     def get_output(self, row: dict):
@@ -88,7 +170,63 @@ class GeneralText2SQL(Bench):
             "question_id": row["question_id"]     
         }
 
-    def process_results(self, generations: str, label: dict, return_details: bool = False, **kwargs):
+    def get_db_file(self, db_id: str) -> str:
+        return os.path.join(self.db_path, db_id, db_id + '.sqlite')
+
+    def get_execute_args(self, generations: str, label: dict) -> tuple[tuple, dict]:
+        db_path = self.get_db_file(label['db_id'])
+        gold = self.gold_store.get(label['question_id'], db_path)
+        return (generations, label['SQL'], db_path), {
+            "meta_time_out": self.sql_timeout,
+            "gold": gold,
+            "max_vm_steps": self.sql_max_vm_steps,
+            "max_extra_rows": self.sql_max_extra_rows,
+            "legacy_hash": self.sql_submission_hash == "legacy"
+        }
+
+    def evaluate(self, generations: str, label: dict) -> dict:
+        error = self.get_sql_error(generations, label['db_id'])
+        if error is not None:
+            # invalid SQL fails without an execution attempt
+            print(Fore.RED + f"Invalid SQL: {generations}" + Style.RESET_ALL)
+            return {"res": 0, "predicted_res": error, "predicted_digest": None, "predicted_hash": None, "gold": None}
+        args, kwargs = self.get_execute_args(generations, label)
+        return execute_model(*args, **kwargs, sandbox=self.sandbox)
+
+    def submit_evaluation(self, generations: str, label: dict) -> Future:
+        if not self.check_sql_validity(generations, label['db_id']):
+            # nothing to run in the background
+            future = Future()
+            future.set_result(self.evaluate(generations, label))
+            return future
+        if self.eval_executor is None:
+            if self.sandbox is not None:
+                # the sandbox already runs the queries in its own process
+                self.eval_executor = ThreadPoolExecutor(max_workers=1)
+            else:
+                # the workers run the queries and share the memory budget, so the validation and
+                # schema connections of this process read the databases from disk from now on
+                set_memory_budget(0)
+                self.eval_executor = ProcessPoolExecutor(
+                    max_workers=self.eval_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=set_memory_budget,
+                    initargs=(self.sql_memory_budget_mb // self.eval_workers,)
+                )
+        if self.sandbox is not None:
+            return self.eval_executor.submit(self.evaluate, generations, label)
+        args, kwargs = self.get_execute_args(generations, label)
+        return self.eval_executor.submit(execute_model, *args, **kwargs)
+
+    def close(self) -> None:
+        if self.eval_executor is not None:
+            self.eval_executor.shutdown(wait=True)
+            self.eval_executor = None
+        if self.sandbox is not None:
+            self.sandbox.stop()
+        self.outcomes.close()
+
+    def process_results(self, generations: str, label: dict, return_details: bool = False, exec_result: dict = None, **kwargs):
         """Takes the list of LM generations and evaluates them against ground truth references,
         returning the metric for the generations.
         :param generations: list(list(str))
@@ -96,63 +234,59 @@ class GeneralText2SQL(Bench):
         :param labels: original labels
             list of str containing refrences
         """
-        db_path = os.path.join(self.db_path, label['db_id'], label['db_id'] + '.sqlite')
-        res = execute_model(generations, label['SQL'], db_path)
-        
-        # for kaggle submission
-        pred_res = res.get("predicted_res", "")
-        self.sql_results.append({
-            "id": label["question_id"],
-            "result": self.hash_prediction(pred_res)
-        })
+        res = exec_result if exec_result is not None else self.evaluate(generations, label)
+        if res["gold"] is not None:
+            # the gold query was run, keep its result for the next steps and runs
+            self.gold_store.put(label['question_id'], self.get_db_file(label['db_id']), res["gold"])
         
         correct = res.get("res", 0)
         self.n_correct += correct
-        self.predictions.append(generations)
-        self.references.append(label)
+        self.outcomes.append(
+            question_id=label["question_id"],
+            db=self.db_ids.setdefault(label['db_id'], len(self.db_ids)),
+            correct=correct,
+            # for kaggle submission: the hash of the predicted result, or the hash of its error message
+            result=self.get_submission_hash(res),
+            sql=generations
+        )
         self.total += 1
-        rolling_acc = self.n_correct / self.total
+        self.metrics.update(correct, group=label['db_id'])
         if return_details:
             return {
                 "result": 'Answer is Correct' if correct == 1 else 'Answer is NOT Correct',
                 "correct": correct,
                 "n_correct": self.n_correct,
-                "rolling_acc": rolling_acc
+                "rolling_acc": self.metrics.accuracy(),
+                "window_acc": self.metrics.window_accuracy()
             }
         return correct
 
     def get_metrics(self):
         return {
-            "EX": self.n_correct / self.total
+            "EX": self.metrics.accuracy(),
+            "window_EX": self.metrics.window_accuracy(),
+            "EX_per_db": self.metrics.group_accuracy()
         }
 
     def give_feedback(self, pred_res: dict) -> bool:
         return bool(pred_res["correct"])
 
-    def normalize_value(self, val):
-        if isinstance(val, float) and val.is_integer():
-            return int(val)
-        return val
-
-    def hash_prediction(self, res):
-        if type(res) is list:
-            # Normalize each tuple and each element within
-            res = [tuple(self.normalize_value(item) for item in t) for t in res]
-            res = [str(item) for item in res]
-            res = sorted(list(set(res)))
-            res = "||".join(res)
-        
-        # Hash the normalized frozenset
+    def get_submission_hash(self, res: dict) -> str:
+        result_hash = res["predicted_hash"] if self.sql_submission_hash == "legacy" else res["predicted_digest"]
+        return result_hash or self.hash_prediction(res["predicted_res"])
+
+    def hash_prediction(self, res: str) -> str:
         return hashlib.md5(res.encode()).hexdigest()
 
     def save_output(self, output_path):
-        df = pd.DataFrame(self.sql_results)
-
         # Ensure the parent directory exists
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-        # Save the DataFrame to the specified path
-        df.to_csv(output_path, index=False)
+        with open(output_path, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["id", "result"])
+            for question_id, result in zip(self.outcomes.column("question_id"), self.outcomes.column("result")):
+                writer.writerow([int(question_id), result.decode()])
 
 # Manual testing
 if __name__ == "__main__":
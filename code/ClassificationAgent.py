@@ -1,6 +1,5 @@
 import os, sys, random, re
 from colorama import Fore, Style
-import torch
 
 sys.path.append(os.getcwd())
 from code.local_model import LLMModelAgent
@@ -10,35 +9,71 @@ class ClassificationAgent(LLMModelAgent):
     """
     An agent that classifies text into one of the labels in the given label set.
     """
+    # a "<number>. <diagnosis>" answer anywhere in the response; the diagnosis is read in a lookahead,
+    # so that every "<number>." of a line is matched
+    ANSWER_PATTERN = re.compile(r"(\d+)\.(?=[ \t]*([^\n]+))")
+    QUERY_KEY = "text"
+
     def __init__(self, config) -> None:
         super().__init__(config=config)
         self.disease_options = ''
         self.symptom = ''
+        self.label2desc = dict()
+        # "generate": free-form generation parsed by extract_label
+        # "score": pick the most likely "<number>. <diagnosis>" continuation
+        self.inference_mode = config.get("inference_mode", "generate")
+        assert self.inference_mode in ["generate", "score"]
     
-    def design_prompt(self, few_shot:bool=False) -> str:
+    def design_prompt_prefix(self) -> str:
         initial_text = "You are a professional medical doctor. Your task is to analyze the patient's symptoms and provide a diagnosis."
+        options_text = f'''
+        All possible diagnoses for you to choose from are listed below (one diagnosis per line, in the format of <number>. <diagnosis>):
+        {self.disease_options}'''
+        return strip_all_lines((initial_text + options_text).strip())
+    
+    def design_prompt(self, few_shot:bool=False) -> str:
+        # the static instruction and options come first, so that their KV cache can be reused
         middle_text = ''
         if few_shot:
             middle_text = f'''
+            
             Below are some simple examples of successful previous predictions with analysis.
         
             {{few_shot_text}}
             '''
+        if self.inference_mode == "score":
+            instruction = "Directly provide the final prediction in this format: <number>. <diagnosis>."
+        else:
+            instruction = "Please follow a concise analysis process, using short sentences for key reasoning steps, and provide the final prediction in this format: <number>. <diagnosis>."
         main_text = f'''
-        All possible diagnoses for you to choose from are listed below (one diagnosis per line, in the format of <number>. <diagnosis>):
-        {self.disease_options}
         
         Here is the case you need to diagnose:
         {self.symptom}
         
-        Please follow a concise analysis process, using short sentences for key reasoning steps, and provide the final prediction in this format: <number>. <diagnosis>.
+        {instruction}
         '''
-        prompt = initial_text + middle_text + main_text
-        
-        return strip_all_lines(prompt.strip())
+        return self.prompt_prefix + strip_all_lines(middle_text + main_text).rstrip()
     
-    @staticmethod
-    def extract_label(pred_text: str, label2desc: dict[str, str]) -> str:
+    @classmethod
+    def match_answer(cls, pred_text: str, label2desc: dict[str, str]) -> str | None:
+        """
+        Return the number of the last "<number>. <diagnosis>" answer whose diagnosis matches the label set.
+        """
+        prediction = None
+        for number, diagnosis in cls.ANSWER_PATTERN.findall(pred_text):
+            label_text = label2desc.get(int(number))
+            if label_text and diagnosis.strip(" *_`").lower().startswith(label_text.lower()):
+                prediction = number
+        return prediction
+
+    def answer_is_complete(self, pred_text: str) -> bool:
+        return self.match_answer(pred_text, self.label2desc) is not None
+
+    @classmethod
+    def extract_label(cls, pred_text: str, label2desc: dict[str, str]) -> str:
+        prediction = cls.match_answer(pred_text, label2desc)
+        if prediction is not None:
+            return prediction
         numbers = re.findall(pattern=r"(\d+)", string=pred_text)
         if len(numbers) == 1:
             number = numbers[0]
@@ -56,22 +91,31 @@ class ClassificationAgent(LLMModelAgent):
                 prediction = random.choice(list(label2desc.keys()))
         return str(prediction)
 
-    def __call__(self, label2desc: dict[str, str], text:str) -> str:
-        self.reset_log_info()
-        self.disease_options = '\n'.join([f"{str(k)}. {v}" for k, v in label2desc.items()])
+    def set_inputs(self, label2desc: dict[str, str], text: str) -> None:
+        if label2desc is not self.label2desc:
+            self.label2desc = label2desc
+            self.disease_options = '\n'.join([f"{str(k)}. {v}" for k, v in label2desc.items()])
+            self.prompt_prefix = self.design_prompt_prefix()
         self.symptom = text
 
-        # get the response from the prompt, 
-        # which has been designed in the design_prompt
-        response = self.get_llm_response(query=self.symptom)
-        
-        # mapping
-        prediction = self.extract_label(response, label2desc)
-        
-        # generate for update
-        self.question = self.symptom
-        self.answer = response + f"\nFinal Answer: {str(prediction)}. {label2desc[int(prediction)]}"
-        
-        torch.cuda.empty_cache()
-        return prediction
+    def generate_batch(self, prepared: list[dict]) -> list[str]:
+        if self.inference_mode != "score":
+            return super().generate_batch(prepared)
+
+        # score every "<number>. <diagnosis>" continuation on top of the prompt and keep the most likely one
+        candidates = [f"{str(k)}. {v}" for k, v in self.label2desc.items()]
+        responses = []
+        for row in prepared:
+            scores = self.score_continuations(row, candidates)
+            response = candidates[max(range(len(candidates)), key=lambda i: scores[i])]
+            self.update_log_info(log_data={
+                "num_output_tokens": len(self.tokenizer.encode(response, add_special_tokens=False)),
+            }, log_info=row["log_info"])
+            responses.append(response)
+        return responses
 
+    def parse_response(self, response: str) -> tuple[str, str]:
+        prediction = self.extract_label(response, self.label2desc)
+        if self.inference_mode == "score":
+            return prediction, response
+        return prediction, response + f"\nFinal Answer: {str(prediction)}. {self.label2desc[int(prediction)]}"
@@ -1,6 +1,5 @@
 import os, sys, re
 from colorama import Fore, Style
-import torch
 
 sys.path.append(os.getcwd())
 from utils import strip_all_lines
@@ -10,45 +9,58 @@ class SQLGenerationAgent(LLMModelAgent):
     """
     An agent that generates SQL code based on the given table schema and the user query.
     """
+    SQL_PATTERN = re.compile(r"```sql([\s\S]*?)```")
+    QUERY_KEY = "user_query"
+
     def __init__(self, config):
         super().__init__(config)
         self.table_schema = ''
         self.user_query = ''
 
+    def design_prompt_prefix(self) -> str:
+        prompt = f"""\
+        You are performing the text-to-SQL task.
+        
+        -- SQL schema: {self.table_schema}"""
+        return strip_all_lines(prompt)
+
     def design_prompt(self, few_shot = False):
+        # the schema comes first, so that its KV cache can be reused across questions on the same db_id
         if not few_shot:
-            prompt = f"""\
-            {self.table_schema}
+            prompt = f"""
             
-            -- Using valid SQLite, answer the following question for the tables provided above.
+            -- Using valid SQLite, answer the following question for the SQL schema provided above.
             -- Question: {self.user_query}
             
             Now, generate the correct SQL code directly in the following format:
             ```sql\n<your_SQL_code>\n```"""
         else:
             prompt = f'''
-            You are performing the text-to-SQL task. Here are some examples:
+            
+            Here are some examples:
             
             {{few_shot_text}}
             
             Now it's your turn.
             
-            -- SQL schema: {self.table_schema}
             -- Using valid SQLite, answer the following question for the SQL schema provided above.
             -- Question: {self.user_query}
             
             Now, generate the correct SQL code directly in the following format:
             ```sql\n<your_SQL_code>\n```
             '''
-        return strip_all_lines(prompt)
+        return self.prompt_prefix + strip_all_lines(prompt)
 
-    @staticmethod
-    def parse_sql(pred_text: str) -> str:
+    def answer_is_complete(self, pred_text: str) -> bool:
+        # the closing fence of the ```sql block has been generated
+        return self.SQL_PATTERN.search(pred_text) is not None
+
+    @classmethod
+    def parse_sql(cls, pred_text: str) -> str:
         """
         Parse the SQL code from the LLM's response.
         """
-        pattern = r"```sql([\s\S]*?)```"
-        match = re.search(pattern, pred_text)
+        match = cls.SQL_PATTERN.search(pred_text)
         if match:
             sql_code = match.group(1)
             sql_code = sql_code.strip()
@@ -58,21 +70,13 @@ class SQLGenerationAgent(LLMModelAgent):
             sql_code = pred_text
         return sql_code
 
-    def __call__(self, table_schema: str, user_query: str) -> str:
-        self.reset_log_info()
-        
-        self.table_schema = table_schema
+    def set_inputs(self, table_schema: str, user_query: str) -> None:
+        # the schema is only stripped again when the db_id changes
+        if (self.prompt_prefix is None) or (table_schema != self.table_schema):
+            self.table_schema = table_schema
+            self.prompt_prefix = self.design_prompt_prefix()
         self.user_query = user_query
-        
-        # get the response from the prompt, 
-        # which has been designed in the design_prompt
-        response = self.get_llm_response(query=user_query)
-        
-        # mapping 
+
+    def parse_response(self, response: str) -> tuple[str, str]:
         sql_code = self.parse_sql(response)
-        
-        # generate for update
-        self.question = user_query
-        self.answer = f"```sql\n{sql_code}\n```"
-        torch.cuda.empty_cache()
-        return sql_code
+        return sql_code, f"```sql\n{sql_code}\n```"
@@ -13,6 +13,30 @@ class LLMArguments:
         default=False,
         metadata={"help":"Whether use 8 bits or not."}
     )
+    prefix_cache_size: Optional[int] = field(
+        default=4,
+        metadata={"help":"Number of static prompt prefixes whose KV cache is kept (0 disables the cache)."}
+    )
+    stop_on_answer: Optional[bool] = field(
+        default=True,
+        metadata={"help":"Whether stop decoding once the answer can be parsed from the response."}
+    )
+    generation_cache_path: Optional[str] = field(
+        default=None,
+        metadata={"help":"SQLite file caching the generated responses across runs (None disables the cache)."}
+    )
+    generation_cache_size_mb: Optional[int] = field(
+        default=512,
+        metadata={"help":"Size of the cached responses beyond which the least recently used ones are evicted."}
+    )
+    log_compression: Optional[str] = field(
+        default=None,
+        metadata={"help":"Compression of the jsonlines log: gzip, zstd (requires zstandard) or None."}
+    )
+    log_dedup_prompts: Optional[bool] = field(
+        default=False,
+        metadata={"help":"Whether write each chunk of the logged prompts once, and refer to it by its hash afterwards."}
+    )
     use_wandb: Optional[bool] = field(
         default=False,
         metadata={"help":"Whether use wandb to track or not."}
@@ -33,12 +57,32 @@ class RAGArguments:
     order: Optional[str] = field(
         default="similar_at_bottom"
     )
+    embedding_cache_size: Optional[int] = field(
+        default=64,
+        metadata={"help":"Number of recently embedded texts kept to avoid re-encoding them at insert time."}
+    )
+    load_dir: Optional[str] = field(
+        default=None,
+        metadata={"help":"Directory of a saved experience store to warm-start the RAG from."}
+    )
+    save_dir: Optional[str] = field(
+        default=None,
+        metadata={"help":"Directory to save the experience store to at the end of the run."}
+    )
 
 @dataclass
 class ClassificationArguments:
     max_tokens: Optional[int] = field(
         default=128
     )
+    inference_mode: Optional[str] = field(
+        default="generate",
+        metadata={"help":"generate: free-form generation; score: choose the most likely label after a single prefill."}
+    )
+    score_batch_size: Optional[int] = field(
+        default=4,
+        metadata={"help":"Number of labels scored together in score mode, each holding a copy of the prompt KV cache."}
+    )
 
 @dataclass
 class SQLGenerationArguments:
@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+class GenerationCache:
+    """
+    On-disk store of generated responses, keyed by a hash of the model, the templated prompt and the decoding config.
+    Decoding is greedy, so a stored response is what the model would generate again.
+    The least recently used responses are evicted once the stored text exceeds max_size_mb.
+    """
+    def __init__(self, path: str, max_size_mb: int = 512) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_size = max_size_mb * 1024 * 1024
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL, "
+            "num_output_tokens INTEGER)"
+        )
+        # caches written before the number of output tokens was stored
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(responses)")]
+        if "num_output_tokens" not in columns:
+            self.conn.execute("ALTER TABLE responses ADD COLUMN num_output_tokens INTEGER")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(prompt: str, **generation_config) -> str:
+        payload = json.dumps({"prompt": prompt, **generation_config}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> tuple[str, int | None] | None:
+        """Return the stored response and its number of output tokens (None if it was not stored), or None on a miss."""
+        row = self.conn.execute("SELECT response, num_output_tokens FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return row[0], row[1]
+
+    def put(self, key: str, response: str, num_output_tokens: int = None) -> None:
+        size = len(response.encode())
+        old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, last_used, num_output_tokens) VALUES (?, ?, ?, ?, ?)",
+            (key, response, size, time.time(), num_output_tokens)
+        )
+        self.size += size - (old[0] if old else 0)
+        self.evict()
+        self.conn.commit()
+
+    def evict(self) -> None:
+        while self.size > self.max_size:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= size
+
+    def close(self) -> None:
+        self.conn.close()
@@ -1,27 +1,61 @@
-import os, re, sys
+import os, sys, time, shutil
+from collections import deque
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache, StoppingCriteriaList
 from colorama import Fore, Style
 from abc import abstractmethod
 
 sys.path.append(os.getcwd())
 from base import Agent
 from utils import RAG, strip_all_lines
+from code.prefix_cache import PrefixKVCache
+from code.generation_cache import GenerationCache
+from code.stopping_criteria import AnswerParsedCriteria, FirstTokenTimer
 
 class LLMModelAgent(Agent):
+    LOG_KEYS = Agent.LOG_KEYS + [
+        "num_cache_hits",  # number of responses read from the generation cache
+        "num_cache_misses",  # number of responses generated and added to the generation cache
+        "num_prefix_hits",  # number of prompts prefilled on top of the cached KV of their static prefix
+        "num_prefix_fallbacks",  # number of prompts with a static prefix whose cached KV could not be reused
+    ]
+    # the input field used as the RAG query
+    QUERY_KEY: str = None
+
     def __init__(self, config) -> None:
         super().__init__(config=config)
         self.config = config
         self.model = self._initialize_model()
         self.tokenizer = AutoTokenizer.from_pretrained(config["model_name"])
+        # left padding for batched generation
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
         self.rag = RAG(self.config["rag"])
         
-        # store for prompt
-        self.question, self.answer = "", ""
+        # (question, answer) of the rows waiting for their feedback, oldest first
+        self.pending_feedback = deque()
+        self.batch_log_info = []
         
         # set the max token for the output
         self.max_token = self.config["max_tokens"]
         
+        # the RAG store referenced by the last checkpoint
+        self.ckpt_rag_dir = None
+        
+        # the static prompt prefix, rebuilt by the agents only when their static inputs change
+        self.prompt_prefix = None
+        
+        # KV cache of the static prompt prefixes (disabled when the size is 0)
+        prefix_cache_size = self.config.get("prefix_cache_size", 0)
+        self.prefix_cache = PrefixKVCache(prefix_cache_size) if prefix_cache_size > 0 else None
+        
+        # on-disk cache of the responses (disabled without a path)
+        generation_cache_path = self.config.get("generation_cache_path")
+        self.generation_cache = GenerationCache(
+            generation_cache_path, self.config.get("generation_cache_size_mb", 512)
+        ) if generation_cache_path else None
+        
     def _initialize_model(self) -> AutoModelForCausalLM:
         """
         Initialize the LLM model
@@ -39,6 +73,20 @@ class LLMModelAgent(Agent):
             kwargs["torch_dtype"] = torch.float16
         return AutoModelForCausalLM.from_pretrained(**kwargs)
 
+    @abstractmethod
+    def set_inputs(self, **inputs) -> None:
+        '''
+        Store the inputs of one row used by design_prompt
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def parse_response(self, response: str) -> tuple[str, str]:
+        '''
+        Map the response to the prediction, and to the answer stored in RAG on positive feedback
+        '''
+        raise NotImplementedError
+
     @abstractmethod 
     def design_prompt(self, few_shot:bool=False) ->str:
         '''
@@ -46,6 +94,20 @@ class LLMModelAgent(Agent):
         '''
         raise NotImplementedError
     
+    def design_prompt_prefix(self) -> str | None:
+        '''
+        The static beginning of the prompt returned by design_prompt,
+        whose KV cache is reused across steps. None if there is no such prefix.
+        '''
+        return None
+    
+    def answer_is_complete(self, pred_text: str) -> bool:
+        '''
+        Whether the (partial) response already contains a parsable answer,
+        in which case the decoding can stop early
+        '''
+        return False
+    
     @staticmethod
     def get_shot_template() -> str:
         '''
@@ -57,70 +119,308 @@ class LLMModelAgent(Agent):
         {{answer}}"""
         return strip_all_lines(prompt)
     
-    def generate_response(self, messages: list) -> str:
-        text_chat = self.tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
+    def prepare_batch(self, inputs: list[dict]) -> list[dict]:
+        '''
+        Retrieve the shots of all rows in one search, then design and tokenize their prompts
+        against the current RAG state
+        '''
+        queries = [x[self.QUERY_KEY] for x in inputs]
+        with self.timer.stage("retrieve"):
+            if self.rag.insert_acc > 0:
+                shots_list = self.rag.retrieve_many(queries, top_k=self.rag.top_k)
+            else:
+                shots_list = [[] for _ in queries]
+        
+        prepared = []
+        for x, query, shots in zip(inputs, queries, shots_list):
+            with self.timer.stage("prompt_build"):
+                self.set_inputs(**x)
+                user_prompt = self.design_user_prompt(shots)
+                # modified for llm
+                messages = [{"role": "user", "content": user_prompt}]
+                text_chat = self.tokenizer.apply_chat_template(
+                    messages,
+                    tokenize=False,
+                    add_generation_prompt=True
+                )
+            with self.timer.stage("tokenize"):
+                input_ids = self.tokenize_prompt(text_chat, self.prompt_prefix)
+            log_info = {KEY: 0 for KEY in self.LOG_KEYS}
+            self.update_log_info(log_data={
+                "num_shots": str(len(shots)),
+                "input_pred": user_prompt,
+            }, log_info=log_info)
+            prepared.append({
+                "query": query,
+                "text_chat": text_chat,
+                "input_ids": input_ids,
+                "prefix": self.prompt_prefix,
+                "log_info": log_info
+            })
+        return prepared
+
+    def tokenize_prompt(self, text_chat: str, prefix: str | None) -> list[int]:
+        '''
+        Tokenize the templated prompt. With the prefix cache, the text up to the end of the static prefix and
+        the rest are tokenized apart, so that the prompt starts with the very tokens of the cached prefix
+        (a merge across the boundary would otherwise prevent reusing it)
+        '''
+        prefix_start = text_chat.find(prefix) if (prefix and (self.prefix_cache is not None)) else -1
+        if prefix_start < 0:
+            return self.tokenizer(text_chat).input_ids
+        prefix_end = prefix_start + len(prefix)
+        return (
+            self.tokenizer(text_chat[:prefix_end]).input_ids
+            + self.tokenizer(text_chat[prefix_end:], add_special_tokens=False).input_ids
         )
-        model_inputs = self.tokenizer([text_chat], return_tensors="pt").to(self.model.device)
+
+    def get_prefix_kwargs(self, row: dict, input_ids: torch.Tensor) -> dict:
+        '''
+        Return the kwargs reusing the cached KV of the static prefix of the row, and count whether it could be reused
+        '''
+        if (not row["prefix"]) or (self.prefix_cache is None):
+            return dict()
+        with self.timer.stage("prefix_cache"):
+            cache_kwargs = self.prefix_cache.get_generate_kwargs(
+                self.model, self.tokenizer, row["text_chat"], row["prefix"], input_ids
+            )
+        hit = int(bool(cache_kwargs))
+        self.update_log_info(log_data={
+            "num_prefix_hits": hit,
+            "num_prefix_fallbacks": 1 - hit,
+        }, log_info=row["log_info"])
+        return cache_kwargs
+
+    def generate_batch(self, prepared: list[dict]) -> list[str]:
+        '''
+        Generate the responses of the prepared rows with one `generate` call.
+        A single row reuses the KV cache of its static prefix.
+        '''
+        if len(prepared) == 1:
+            row = prepared[0]
+            model_inputs = {"input_ids": torch.tensor([row["input_ids"]], device=self.model.device)}
+            model_inputs["attention_mask"] = torch.ones_like(model_inputs["input_ids"])
+        else:
+            model_inputs = self.tokenizer.pad(
+                {"input_ids": [row["input_ids"] for row in prepared]}, return_tensors="pt"
+            ).to(self.model.device)
+        num_input_tokens = model_inputs["input_ids"].shape[1]
+        
+        # reuse the KV cache of the static prefix, so only the suffix is prefilled
+        cache_kwargs = dict()
+        if len(prepared) == 1:
+            cache_kwargs = self.get_prefix_kwargs(prepared[0], model_inputs["input_ids"])
+        
+        # time the prefill (up to the first new token) apart from the decoding
+        first_token_timer = FirstTokenTimer()
+        stopping_criteria = StoppingCriteriaList([first_token_timer])
+        # stop decoding once the answer can be parsed
+        if self.config.get("stop_on_answer", False):
+            stopping_criteria.append(AnswerParsedCriteria(self.tokenizer, num_input_tokens, self.answer_is_complete))
         
         # output the tokenized ids 
         # it would include the problem and the answer
+        start_time = time.perf_counter()
         generated_ids = self.model.generate(
             **model_inputs,
+            **cache_kwargs,
             max_new_tokens=self.config["max_tokens"],
-            do_sample=False
+            do_sample=False,
+            stopping_criteria=stopping_criteria,
+            pad_token_id=self.tokenizer.pad_token_id
         )
+        end_time = time.perf_counter()
+        first_token_time = first_token_timer.first_token_time or end_time
+        self.timer.add("prefill", first_token_time - start_time)
+        self.timer.add("decode", end_time - first_token_time)
         # extract only the output content
-        generated_ids = [
-            output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
-        return self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+        generated_ids = generated_ids[:, num_input_tokens:]
+        for row, output_ids in zip(prepared, generated_ids):
+            self.update_log_info(log_data={
+                "num_input_tokens": len(row["input_ids"]),
+                "num_output_tokens": int((output_ids != self.tokenizer.pad_token_id).sum()),
+            }, log_info=row["log_info"])
+        return self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
 
-    def update(self, correctness: bool) -> bool:
+    def generate_cached(self, prepared: list[dict]) -> list[str]:
         '''
-        store the positive response in RAG
+        Read the responses of the prepared rows from the generation cache, and generate the missing ones
         '''
-        if correctness:
-            chunk = self.get_shot_template().format(question=self.question, answer=self.answer)
-            self.rag.insert(key=self.question, value=chunk)
-        return correctness
-
-    def get_llm_response(self, query:str) -> str:
-        # design the prompt
-        prompt_zero_shot = self.design_prompt(few_shot=False)
-        prompt_few_shot = self.design_prompt(few_shot=True)
+        if self.generation_cache is None:
+            return self.generate_batch(prepared)
         
-        # extract from RAG
-        shots = self.rag.retrieve(query=query, top_k=self.rag.top_k) if self.rag.insert_acc > 0 else []
+        with self.timer.stage("generation_cache"):
+            keys = [
+                self.generation_cache.make_key(
+                    row["text_chat"],
+                    model_name=self.config["model_name"],
+                    use_8bit=self.config["use_8bit"],
+                    max_tokens=self.config["max_tokens"],
+                    do_sample=self.config.get("do_sample", False),
+                    stop_on_answer=self.config.get("stop_on_answer", False),
+                    inference_mode=self.config.get("inference_mode", "generate")
+                )
+                for row in prepared
+            ]
+            cached = [self.generation_cache.get(key) for key in keys]
+        responses = [entry[0] if entry is not None else None for entry in cached]
+        misses = [i for i, entry in enumerate(cached) if entry is None]
+        if misses:
+            tokens_before = [prepared[i]["log_info"]["num_output_tokens"] for i in misses]
+            generated = self.generate_batch([prepared[i] for i in misses])
+            with self.timer.stage("generation_cache"):
+                for i, response, num_tokens in zip(misses, generated, tokens_before):
+                    # stored with the output tokens generate_batch counted for this row
+                    num_tokens = prepared[i]["log_info"]["num_output_tokens"] - num_tokens
+                    self.generation_cache.put(keys[i], response, num_tokens)
+                    responses[i] = response
+        for i, row in enumerate(prepared):
+            hit = int(i not in misses)
+            log_data = {
+                "num_cache_hits": hit,
+                "num_cache_misses": 1 - hit,
+            }
+            if hit:
+                # a replayed response still counts the tokens it was generated from and into
+                num_output_tokens = cached[i][1]
+                if num_output_tokens is None:
+                    num_output_tokens = len(self.tokenizer.encode(responses[i], add_special_tokens=False))
+                log_data.update({
+                    "num_input_tokens": len(row["input_ids"]),
+                    "num_output_tokens": num_output_tokens,
+                })
+            self.update_log_info(log_data=log_data, log_info=row["log_info"])
+        return responses
+
+    @torch.no_grad()
+    def score_continuations(self, row: dict, continuations: list[str]) -> list[float]:
+        '''
+        Compute the log-likelihood of each continuation right after the prepared prompt.
+        The prompt is prefilled once, and the continuations are scored in batches of
+        score_batch_size on top of its KV cache. The prompt cache is repeated for each row of a
+        batch, so score_batch_size bounds the number of its copies held at once.
+        '''
+        input_ids = torch.tensor([row["input_ids"]], device=self.model.device)
+        num_prompt_tokens = input_ids.shape[1]
+        self.update_log_info(log_data={"num_input_tokens": num_prompt_tokens}, log_info=row["log_info"])
         
-        # set the user prompt for each case, depends on some conditions
-        if len(shots):
-            few_shot_text = "\n\n\n".join(shots).replace("\\", "\\\\")
-            try:
-                user_prompt = re.sub(pattern=r"\{few_shot_text\}",  repl=few_shot_text, string=prompt_few_shot)
-            except Exception as e:
-                error_msg = f"Error ```{e}``` caused by these shots. Using the zero-shot prompt."
-                print(Fore.RED + error_msg + Fore.RESET)
-                user_prompt = prompt_zero_shot
-        else:
-            print(Fore.YELLOW + "No RAG shots found. Using zeroshot prompt." + Fore.RESET)
-            user_prompt = prompt_zero_shot
+        # prefill the prompt, reusing the KV cache of the static prefix if possible
+        cache_kwargs = self.get_prefix_kwargs(row, input_ids)
+        cache = cache_kwargs.get("past_key_values", DynamicCache())
+        num_cached_tokens = cache.get_seq_length()
+        with self.timer.stage("prefill"):
+            prompt_outputs = self.model(
+                input_ids=input_ids[:, num_cached_tokens:],
+                past_key_values=cache,
+                use_cache=True
+            )
+        cache = prompt_outputs.past_key_values
+        last_logits = prompt_outputs.logits[:, -1:]
         
-        # modified for llm
-        messages = [{"role": "user", "content": user_prompt}]
+        continuation_ids = [self.tokenizer.encode(text, add_special_tokens=False) for text in continuations]
+        batch_size = self.config.get("score_batch_size", 4)
+        scores = []
+        for start in range(0, len(continuation_ids), batch_size):
+            batch_ids = continuation_ids[start:start + batch_size]
+            # right-pad the continuations of the batch
+            max_length = max(len(ids) for ids in batch_ids)
+            pad_id = self.tokenizer.pad_token_id
+            input_ids = torch.tensor(
+                [ids + [pad_id] * (max_length - len(ids)) for ids in batch_ids], device=self.model.device
+            )
+            token_mask = torch.tensor(
+                [[1] * len(ids) + [0] * (max_length - len(ids)) for ids in batch_ids], device=self.model.device
+            )
+            attention_mask = torch.cat([
+                torch.ones((len(batch_ids), num_prompt_tokens), dtype=token_mask.dtype, device=self.model.device),
+                token_mask
+            ], dim=1)
+            if len(batch_ids) > 1:
+                cache.batch_repeat_interleave(len(batch_ids))
+            with self.timer.stage("decode"):
+                outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=cache, use_cache=True)
+            # back to the prompt cache of a single row for the next batch
+            cache.crop(num_prompt_tokens)
+            if len(batch_ids) > 1:
+                cache.batch_select_indices(torch.tensor([0], device=self.model.device))
+            
+            # the first token is predicted by the last prompt position
+            logits = torch.cat([
+                last_logits.expand(len(batch_ids), -1, -1),
+                outputs.logits[:, :-1]
+            ], dim=1).float()
+            token_logprobs = logits.gather(-1, input_ids.unsqueeze(-1)).squeeze(-1) - torch.logsumexp(logits, dim=-1)
+            scores.extend((token_logprobs * token_mask).sum(dim=-1).tolist())
+        return scores
+
+    def __call__(self, **inputs) -> str:
+        return self.batch_call([inputs])[0]
+
+    def batch_call(self, inputs: list[dict], prepared: list[dict] = None) -> list[str]:
+        '''
+        Answer a micro-batch of rows against the current RAG state.
+        The answer of each row is queued, and update() consumes the feedback of the rows in order.
+        '''
+        if prepared is None:
+            prepared = self.prepare_batch(inputs)
+        responses = self.generate_cached(prepared)
         
-        # get prediction
-        response = self.generate_response(messages)
+        predictions = []
+        self.batch_log_info = []
+        for row, response in zip(prepared, responses):
+            # mapping
+            prediction, answer = self.parse_response(response)
+            # store for update
+            self.pending_feedback.append((row["query"], answer))
+            self.update_log_info(log_data={"output_pred": response}, log_info=row["log_info"])
+            self.batch_log_info.append(row["log_info"])
+            predictions.append(prediction)
+        self.log_info = self.batch_log_info[-1]
         
-        # update log
-        self.update_log_info(log_data={
-            "num_input_tokens": len(self.tokenizer.encode(user_prompt)),
-            "num_output_tokens": len(self.tokenizer.encode(response)),
-            "num_shots": str(len(shots)),
-            "input_pred": user_prompt,
-            "output_pred": response,
-        })
-        
-        return response
\ No newline at end of file
+        torch.cuda.empty_cache()
+        return predictions
+
+    def update(self, correctness: bool) -> bool:
+        '''
+        store the positive response of the oldest row without feedback in RAG
+        '''
+        question, answer = self.pending_feedback.popleft()
+        if correctness:
+            chunk = self.get_shot_template().format(question=question, answer=answer)
+            self.rag.insert(key=question, value=chunk)
+        return correctness
+
+    def save_checkpoint(self, ckpt_dir: str) -> dict:
+        state = super().save_checkpoint(ckpt_dir)
+        # the store is named after its size, so an unchanged store is not written again
+        rag_dir = f"rag-{self.rag.insert_acc}"
+        if not os.path.exists(os.path.join(ckpt_dir, rag_dir, "evidence.json")):
+            self.rag.save(os.path.join(ckpt_dir, rag_dir))
+        # the store of the previous checkpoint is kept until the new one is committed
+        self.ckpt_rag_dir = rag_dir
+        state["rag_dir"] = rag_dir
+        state["pending_feedback"] = list(self.pending_feedback)
+        return state
+
+    def commit_checkpoint(self, ckpt_dir: str) -> None:
+        # the state now references self.ckpt_rag_dir only, so the older stores can go
+        for name in os.listdir(ckpt_dir):
+            if name.startswith("rag-") and name != self.ckpt_rag_dir:
+                shutil.rmtree(os.path.join(ckpt_dir, name))
+
+    def load_checkpoint(self, ckpt_dir: str, state: dict) -> None:
+        super().load_checkpoint(ckpt_dir, state)
+        self.rag.load(os.path.join(ckpt_dir, state["rag_dir"]))
+        self.ckpt_rag_dir = state["rag_dir"]
+        self.pending_feedback = deque(state["pending_feedback"])
+
+    def design_user_prompt(self, shots: list[str]) -> str:
+        '''
+        Fill the designed prompt with the retrieved shots
+        '''
+        # design only the prompt variant that is used
+        if len(shots):
+            few_shot_text = "\n\n\n".join(shots)
+            return self.design_prompt(few_shot=True).replace("{few_shot_text}", few_shot_text, 1)
+        print(Fore.YELLOW + "No RAG shots found. Using zeroshot prompt." + Fore.RESET)
+        return self.design_prompt(few_shot=False)
@@ -0,0 +1,49 @@
+import copy
+from collections import OrderedDict
+import torch
+from transformers import DynamicCache
+
+class PrefixKVCache:
+    """
+    LRU store of the `past_key_values` computed for static prompt prefixes
+    (e.g. the instruction + options for classification, or the schema of one db_id).
+    """
+    def __init__(self, max_entries: int = 4) -> None:
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # prefix text -> (prefix input_ids, DynamicCache)
+
+    def lookup(self, model, tokenizer, prefix_text: str) -> tuple[torch.Tensor, DynamicCache]:
+        '''
+        Return the token ids of the prefix and its KV cache, prefilling it on a miss
+        '''
+        if prefix_text in self.entries:
+            self.entries.move_to_end(prefix_text)
+            return self.entries[prefix_text]
+
+        prefix_inputs = tokenizer([prefix_text], return_tensors="pt").to(model.device)
+        with torch.no_grad():
+            outputs = model(**prefix_inputs, past_key_values=DynamicCache(), use_cache=True)
+        self.entries[prefix_text] = (prefix_inputs.input_ids, outputs.past_key_values)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return self.entries[prefix_text]
+
+    def get_generate_kwargs(self, model, tokenizer, text_chat: str, prefix: str, input_ids: torch.Tensor) -> dict:
+        '''
+        Build the extra `generate` kwargs that reuse the cached prefix of `text_chat`.
+        Return an empty dict when the prefix cannot be reused for these input ids.
+        '''
+        prefix_start = text_chat.find(prefix)
+        if prefix_start < 0:
+            return {}
+        prefix_ids, prefix_kv = self.lookup(model, tokenizer, text_chat[:prefix_start + len(prefix)])
+
+        # the prefix must tokenize identically inside the full prompt
+        # and leave at least one token for generate to prefill
+        num_prefix_tokens = prefix_ids.shape[1]
+        if num_prefix_tokens >= input_ids.shape[1]:
+            return {}
+        if not torch.equal(input_ids[0, :num_prefix_tokens], prefix_ids[0]):
+            return {}
+        # generate extends the cache in place, so hand it a copy
+        return {"past_key_values": copy.deepcopy(prefix_kv)}
@@ -0,0 +1,33 @@
+import time
+from typing import Callable
+import torch
+from transformers import StoppingCriteria
+
+class AnswerParsedCriteria(StoppingCriteria):
+    """
+    Stop decoding a sequence as soon as its generated text can be parsed into an answer.
+    """
+    def __init__(self, tokenizer, prompt_length: int, is_complete: Callable[[str], bool]) -> None:
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.is_complete = is_complete
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        is_done = [self.is_complete(text) for text in texts]
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+class FirstTokenTimer(StoppingCriteria):
+    """
+    Never stops decoding; records when the first new token is available,
+    which splits the time of `generate` into prefill and decode.
+    """
+    def __init__(self) -> None:
+        self.first_token_time = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.first_token_time is None:
+            if input_ids.is_cuda:
+                torch.cuda.synchronize(input_ids.device)
+            self.first_token_time = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
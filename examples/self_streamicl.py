@@ -2,16 +2,12 @@ import re
 import random
 from base import Agent
 from colorama import Fore, Style
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 import warnings
-from transformers import logging as transformers_logging
 
 from utils import RAG, strip_all_lines
 
 # Ignore warning messages from transformers
 warnings.filterwarnings("ignore")
-transformers_logging.set_verbosity_error()
 
 class LocalModelAgent(Agent):
     """
@@ -21,6 +17,12 @@ class LocalModelAgent(Agent):
         """
         Initialize the local model
         """
+        # imported here rather than at the top, so that parsing the arguments (and --offline) comes first
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+        from transformers import logging as transformers_logging
+        transformers_logging.set_verbosity_error()
+
         super().__init__(config)
         self.llm_config = config
         if config['use_8bit']:
@@ -44,6 +46,7 @@ class LocalModelAgent(Agent):
         # Save the streaming inputs and outputs for iterative improvement
         self.inputs = list()
         self.self_outputs = list()
+        self.num_feedbacks = 0  # the feedback of each step arrives in order, possibly delayed
         self.model.eval()
 
     def generate_response(self, messages: list) -> str:
@@ -72,9 +75,10 @@ class LocalModelAgent(Agent):
         """
         Update the agent based on the correctness of its output.
         """
+        question = self.inputs[self.num_feedbacks]
+        answer = self.self_outputs[self.num_feedbacks]
+        self.num_feedbacks += 1
         if correctness:
-            question = self.inputs[-1]
-            answer = self.self_outputs[-1]
             chunk = self.get_shot_template().format(question=question, answer=answer)
             self.rag.insert(key=question, value=chunk)
             return True
@@ -304,7 +308,7 @@ class SQLGenerationAgent(LocalModelAgent):
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
-    from execution_pipeline import main
+    from utils import set_offline_mode
 
     parser = ArgumentParser()
     parser.add_argument('--bench_name', type=str, required=True)
@@ -314,7 +318,11 @@ if __name__ == "__main__":
     parser.add_argument('--use_8bit', action='store_true')
     parser.add_argument('--output_path', type=str, default=None, help='path to save csv file for kaggle submission')
     parser.add_argument('--use_wandb', action='store_true')
+    parser.add_argument('--offline', action='store_true', help='only use the models and datasets in the local Hugging Face cache')
     args = parser.parse_args()
+    if args.offline:
+        set_offline_mode()
+    from execution_pipeline import main
 
     if args.bench_name.startswith("classification"):
         max_tokens = 16
@@ -2,73 +2,276 @@ import os
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 import json
+import time
+import pickle
+import random
+from collections import deque
 from tqdm import tqdm
 from colorama import Fore, Style
 
-from utils import merge_dicts
+from utils import merge_dicts, StageTimer
 from benchmarks import load_benchmark, Bench
 
-def main(agent, bench_cfg, debug: bool = False, debug_samples: int = 10, use_wandb: bool = False, wandb_name: str = None, wandb_config: dict = None):
+CHECKPOINT_STATE = "state.pkl"
+
+def save_checkpoint(ckpt_dir: str, time_step: int, agent, bench: Bench, pending_feedback: deque) -> None:
+    """Save the progress of the stream after time_step into ckpt_dir."""
+    os.makedirs(ckpt_dir, exist_ok=True)
+    state = {
+        "time_step": time_step,
+        "pending_feedback": list(pending_feedback),
+        "bench": bench.state_dict(),
+        "agent": agent.save_checkpoint(ckpt_dir),
+        "random_state": random.getstate()
+    }
+    # the state file is replaced last, so that a crash while checkpointing keeps the previous checkpoint usable
+    state_path = os.path.join(ckpt_dir, CHECKPOINT_STATE)
+    with open(state_path + ".tmp", 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+    agent.commit_checkpoint(ckpt_dir)
+
+def load_checkpoint(ckpt_dir: str, agent, bench: Bench) -> tuple[int, deque]:
+    """Restore the agent and the bench from ckpt_dir. Return the time_step to resume from and the pending feedback."""
+    with open(os.path.join(ckpt_dir, CHECKPOINT_STATE), 'rb') as f:
+        state = pickle.load(f)
+    bench.load_state_dict(state["bench"])
+    agent.load_checkpoint(ckpt_dir, state["agent"])
+    random.setstate(state["random_state"])
+    return state["time_step"] + 1, deque(state["pending_feedback"])
+
+def summarize_latency(agent) -> dict:
+    """Per-stage latency percentiles of the run, and the generation throughput."""
+    stages = agent.timer.summary()
+    generation_time = sum(stages.get(stage, {}).get("total", 0.0) for stage in ["prefill", "decode"])
+    num_output_tokens = agent.accum_log_info.get("num_output_tokens", 0)
+    return {
+        "stages": stages,
+        "output_tokens_per_sec": num_output_tokens / generation_time if generation_time > 0 else 0.0
+    }
+
+def print_latency_summary(latency_summary: dict) -> None:
+    print(Fore.CYAN + f"{'stage':<16}{'count':>8}{'total(s)':>12}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}" + Style.RESET_ALL)
+    for stage, stats in latency_summary["stages"].items():
+        print(
+            f"{stage:<16}{stats['count']:>8}{stats['total']:>12.2f}"
+            f"{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}"
+        )
+    print(f"Output tokens/sec: {latency_summary['output_tokens_per_sec']:.2f}")
+
+def print_startup_report(startup_timer: StageTimer) -> None:
+    """Print the time spent importing and initializing each component before the first batch was answered."""
+    stages = startup_timer.summary()
+    print(Fore.CYAN + f"{'startup stage':<20}{'time(s)':>10}" + Style.RESET_ALL)
+    for stage, stats in stages.items():
+        print(f"{stage:<20}{stats['total']:>10.2f}")
+    print(f"Time to first batch: {sum(stats['total'] for stats in stages.values()):.2f}s")
+
+def main(
+    agent,
+    bench_cfg,
+    debug: bool = False,
+    debug_samples: int = 10,
+    use_wandb: bool = False,
+    wandb_name: str = None,
+    wandb_config: dict = None,
+    checkpoint_dir: str = None,
+    checkpoint_every: int = 100,
+    resume: bool = False,
+    batch_size: int = 1,
+    feedback_delay: int = 0,
+    async_eval: bool = False,
+    startup_timer: StageTimer = None
+):
+    """Run the agent on the stream of the benchmark.
+
+    The rows are answered in micro-batches of batch_size rows, all built against the same RAG state.
+    The feedback of time_step t is given to the agent once the row t + feedback_delay has been evaluated.
+    With async_eval, the rows are evaluated in the background (bench.submit_evaluation) while the next batch
+    is prepared, and the pipeline only waits for an evaluation when its feedback is due.
+    With a startup_timer (holding e.g. the import times of the caller), the startup report is printed after the first batch.
+    """
+    assert batch_size >= 1 and feedback_delay >= 0
     bench_cfg['agent'] = agent
     # bench_cfg['agent_callback'] = agent.retrieve_experience
     print('init bench environment')
-    bench: Bench = load_benchmark(bench_cfg['bench_name'])(**bench_cfg)
-    agent.bench = bench
-
-    ds = bench.get_dataset()
-    if debug:
-        print(Fore.YELLOW + f"Debug mode: using first {debug_samples} samples" + Style.RESET_ALL)
-        ds = ds.select(range(debug_samples))
-
-    if use_wandb:
-        import wandb
-        wandb.init(
-            project=f"ADL-StreamBench-{bench_cfg['bench_name']}",
-            name=wandb_name,
-            config=wandb_config
-        )
-
-    pbar = tqdm(ds, dynamic_ncols=True)
-    for time_step, row in enumerate(pbar):
-        row['time_step'] = time_step
-        x = bench.get_input(row)
-        model_output = agent(**x)
-        prediction = bench.postprocess_generation(model_output, time_step)
-        label = bench.get_output(row)
-        pred_res = bench.process_results(
-            prediction,
-            label,
-            return_details=True,
-            time_step=time_step
-        )
+    report_startup = startup_timer is not None
+    startup_timer = startup_timer or StageTimer()
+    with startup_timer.stage("bench_init"):
+        bench: Bench = load_benchmark(bench_cfg['bench_name'])(**bench_cfg)
+        agent.bench = bench
+        ds = bench.get_dataset()
+    # the background workers of the bench (e.g. SQL evaluation processes) are released even if the stream fails
+    try:
+        if debug:
+            print(Fore.YELLOW + f"Debug mode: using first {debug_samples} samples" + Style.RESET_ALL)
+            ds = ds.select(range(debug_samples))
 
-        correctness = bench.give_feedback(pred_res)
-        agent.update(correctness)
+        start_step = 0
+        pending_feedback = deque()  # correctness of the evaluated steps not yet given to the agent
+        if checkpoint_dir is not None:
+            has_checkpoint = os.path.exists(os.path.join(checkpoint_dir, CHECKPOINT_STATE))
+            if resume and has_checkpoint:
+                start_step, pending_feedback = load_checkpoint(checkpoint_dir, agent, bench)
+                print(Fore.YELLOW + f"Resuming from time_step {start_step} ({checkpoint_dir})" + Style.RESET_ALL)
+                ds = ds.select(range(start_step, len(ds)))
+            elif has_checkpoint:
+                raise ValueError(f"Found a checkpoint in {checkpoint_dir}. Use resume or another checkpoint directory.")
+        elif resume:
+            raise ValueError("resume requires a checkpoint directory.")
 
         if use_wandb:
-            wandb.log(data=merge_dicts([agent.get_wandb_log_info(), pred_res]))
+            import wandb
+            wandb.init(
+                project=f"ADL-StreamBench-{bench_cfg['bench_name']}",
+                name=wandb_name,
+                config={**(wandb_config or {}), "batch_size": batch_size, "feedback_delay": feedback_delay, "async_eval": async_eval}
+            )
+
+        timer = agent.timer
+        timer.pop_step()  # drop the timings recorded before the stream (e.g. while resuming)
+        pbar = tqdm(total=len(ds), dynamic_ncols=True)
+        last_checkpoint_step = start_step - 1
+        evaluating = deque()  # rows whose evaluation runs in the background, oldest first (async_eval)
+        agent_changed = False  # whether update() changed the agent since the next batch was prepared
+
+        def get_batch(batch_start: int) -> tuple[list[dict], list[dict]]:
+            rows = [ds[i] for i in range(batch_start, min(batch_start + batch_size, len(ds)))]
+            xs = []
+            for i, row in enumerate(rows):
+                row['time_step'] = start_step + batch_start + i
+                with timer.stage("get_input"):
+                    xs.append(bench.get_input(row))
+            return rows, xs
 
-        if isinstance(label, int):
-            label = bench.LABEL2TEXT[label]
-        elif isinstance(label, dict):
-            label = label.get("label", json.dumps(label))
-        agent.log(label_text=label)
+        def resolve(entry: dict) -> None:
+            """Grade an answered row, give the agent the feedback whose delay has passed, and log the row."""
+            nonlocal agent_changed
+            time_step, label, log_info = entry["time_step"], entry["label"], entry["log_info"]
+            kwargs = {}
+            if "future" in entry:
+                with timer.stage("eval_wait"):
+                    kwargs["exec_result"] = entry["future"].result()
+            with timer.stage("process_results"):
+                pred_res = bench.process_results(
+                    entry["prediction"],
+                    label,
+                    return_details=True,
+                    time_step=time_step,
+                    **kwargs
+                )
 
-        # Update rolling accuracy in tqdm
-        pbar.set_description(f"Step {time_step} | Rolling Accuracy: {pred_res['rolling_acc'] * 100:.2f}%")
-        pbar.update(1)
-    pbar.close()
+            # give the agent the feedback whose delay has passed
+            pending_feedback.append(bench.give_feedback(pred_res))
+            while pending_feedback and (len(pending_feedback) + len(evaluating) > feedback_delay):
+                with timer.stage("update"):
+                    agent_changed |= bool(agent.update(pending_feedback.popleft()))
+            log_info["latency"] = {**entry["batch_timings"], **timer.pop_step()}
 
-    metrics = bench.get_metrics()
-    print(metrics)
-    if use_wandb:
-        wandb.log(data={f"final/{k}": v for k, v in metrics.items()})
+            if use_wandb:
+                wandb.log(data=merge_dicts([agent.get_wandb_log_info(log_info), pred_res]))
+
+            if isinstance(label, int):
+                label = bench.LABEL2TEXT[label]
+            elif isinstance(label, dict):
+                label = label.get("label", json.dumps(label))
+            agent.log(label_text=label, log_info=log_info)
+
+            # Update rolling accuracy in tqdm
+            pbar.set_description(f"Step {time_step} | Rolling Accuracy: {pred_res['rolling_acc'] * 100:.2f}%")
+            pbar.update(1)
+
+        prefetched = None  # (rows, xs, prepared, timings) of the next batch, prepared while the current batch is evaluated
+        stream_start = time.perf_counter()
+        for batch_start in range(0, len(ds), batch_size):
+            if prefetched is None:
+                rows, xs = get_batch(batch_start)
+                prepared, prefetch_timings = None, dict()
+            else:
+                rows, xs, prepared, prefetch_timings = prefetched
+                if agent_changed:
+                    # the feedback changed the agent after the batch was prepared, so it is prepared again
+                    prepared = None
+                prefetched = None
+            model_outputs = agent.batch_call(xs, prepared=prepared)
+            # the stages up to the generation are shared by the rows of the batch
+            batch_timings = timer.pop_step()
+            for stage, seconds in prefetch_timings.items():
+                batch_timings[stage] = round(batch_timings.get(stage, 0.0) + seconds, 6)
+            if report_startup and (batch_start == 0):
+                startup_timer.add("first_batch", time.perf_counter() - stream_start)
+                print_startup_report(startup_timer)
+
+            for row, model_output, log_info in zip(rows, model_outputs, agent.batch_log_info):
+                with timer.stage("postprocess"):
+                    prediction = bench.postprocess_generation(model_output, row['time_step'])
+                entry = {
+                    "time_step": row['time_step'],
+                    "prediction": prediction,
+                    "label": bench.get_output(row),
+                    "log_info": log_info,
+                    # the shared stages of the batch, and the postprocessing of this row
+                    "batch_timings": {**batch_timings, **timer.pop_step()}
+                }
+                if async_eval:
+                    entry["future"] = bench.submit_evaluation(entry["prediction"], entry["label"])
+                    evaluating.append(entry)
+                else:
+                    resolve(entry)
+
+            if async_eval:
+                # prepare the next batch while this one is evaluated
+                if batch_start + batch_size < len(ds):
+                    next_rows, next_xs = get_batch(batch_start + batch_size)
+                    agent_changed = False
+                    next_prepared = agent.prepare_batch(next_xs)
+                    # the prefetch is charged to the next batch, not to the rows resolved below
+                    prefetched = (next_rows, next_xs, next_prepared, timer.pop_step())
+                # and only wait for the evaluations whose feedback is due before the next batch
+                while evaluating and (len(evaluating) + len(pending_feedback) > feedback_delay):
+                    resolve(evaluating.popleft())
+
+            time_step = rows[-1]['time_step']
+            if (checkpoint_dir is not None) and (time_step - last_checkpoint_step >= checkpoint_every):
+                # the checkpoint holds the feedback of every answered row
+                while evaluating:
+                    resolve(evaluating.popleft())
+                save_checkpoint(checkpoint_dir, time_step, agent, bench, pending_feedback)
+                last_checkpoint_step = time_step
+        while evaluating:
+            resolve(evaluating.popleft())
+        pbar.close()
+
+        # the remaining feedback still updates the agent (e.g. the RAG store saved after the run)
+        while len(pending_feedback):
+            agent.update(pending_feedback.popleft())
+
+        if (checkpoint_dir is not None) and (len(ds) > 0):
+            save_checkpoint(checkpoint_dir, time_step, agent, bench, pending_feedback)
+
+        metrics = bench.get_metrics()
+        metrics.update({"batch_size": batch_size, "feedback_delay": feedback_delay, "async_eval": async_eval})
+        print(metrics)
+        if use_wandb:
+            wandb.log(data={f"final/{k}": v for k, v in metrics.items()})
+
+        agent.flush_log()
+        latency_summary = summarize_latency(agent)
+        print_latency_summary(latency_summary)
+        with open(agent.log_path.rsplit(".jsonl", 1)[0] + "_latency.json", 'w') as f:
+            json.dump(latency_summary, f, indent=4)
+        if use_wandb:
+            wandb.log(data={
+                f"latency/{stage}_{k}": v for stage, stats in latency_summary["stages"].items() for k, v in stats.items()
+            })
 
-    output_path = bench_cfg.get("output_path", None)
-    if output_path is not None:
-        bench.save_output(output_path)
+        output_path = bench_cfg.get("output_path", None)
+        if output_path is not None:
+            bench.save_output(output_path)
 
-    return metrics
+        return metrics
+    finally:
+        bench.close()
 
 if __name__ == "__main__":
     main()
@@ -3,31 +3,56 @@ from argparse import ArgumentParser
 from datetime import datetime
 from types import SimpleNamespace
 from dotenv import load_dotenv
-from huggingface_hub import login
 
-from execution_pipeline import main
+# the pipeline, the agents and the Hugging Face libraries are imported after the arguments are parsed,
+# so that --offline is set before they read it, and --startup_report can time them
 from code.arguments import LLMArguments, RAGArguments, ClassificationArguments, SQLGenerationArguments
-from code.ClassificationAgent import ClassificationAgent
-from code.SQLGenerationAgent import SQLGenerationAgent
+from utils import StageTimer, set_offline_mode
 
 def _parse_args():
     parser = ArgumentParser()
     parser.add_argument('--bench_name', type=str, required=True, choices=["classification_public", "sql_generation_public"])
     parser.add_argument('--output_path', type=str, required=True)
+    parser.add_argument('--checkpoint_dir', type=str, default=None, help='directory to save periodic checkpoints of the stream')
+    parser.add_argument('--checkpoint_every', type=int, default=100, help='number of time steps between two checkpoints')
+    parser.add_argument('--resume', action='store_true', help='resume the stream from the checkpoint in checkpoint_dir')
+    parser.add_argument('--batch_size', type=int, default=1, help='number of rows generated together against the same RAG state')
+    parser.add_argument('--feedback_delay', type=int, default=0, help='number of later steps evaluated before the feedback of a step reaches the agent')
+    parser.add_argument('--async_eval', action='store_true', help='evaluate the answers in the background while the next rows are prepared')
+    parser.add_argument('--eval_workers', type=int, default=4, help='number of processes evaluating the SQL answers with async_eval')
+    parser.add_argument('--schema_linking', action='store_true', help='only put the tables and columns related to the question in the SQL prompts')
+    parser.add_argument('--schema_token_budget', type=int, default=1024, help='approximate number of tokens of a pruned schema')
+    parser.add_argument('--sql_timeout', type=float, default=30, help='seconds before a SQL query is interrupted')
+    parser.add_argument('--sql_max_vm_steps', type=int, default=None, help='number of SQLite VM instructions before a SQL query is interrupted')
+    parser.add_argument('--sql_max_extra_rows', type=int, default=1000, help='number of distinct rows beyond the gold result after which a predicted result stops being fetched')
+    parser.add_argument('--sql_memory_budget_mb', type=int, default=0, help='MB of RAM used to keep the most recently used databases in memory, split across the eval_workers with async_eval (0 reads them from disk)')
+    parser.add_argument('--sql_submission_hash', type=str, default='legacy', choices=['legacy', 'fingerprint'], help='hash of the predicted results in the submission csv (legacy matches the Kaggle references)')
+    parser.add_argument('--sql_sandbox', action='store_true', help='run SQL queries in a worker process with memory and CPU limits')
+    parser.add_argument('--offline', action='store_true', help='skip the Hugging Face login and only use the models and datasets in the local cache')
+    parser.add_argument('--startup_report', action='store_true', help='print the import and initialization time of each component after the first batch')
     return parser.parse_args()
 
 if __name__ == "__main__":
+    bench_args = _parse_args()
+    startup_timer = StageTimer()
+
     # access through api 
     load_dotenv()
-    token = os.getenv("HUGGINGFACE_HUB_TOKEN")
-    login(token)
+    if bench_args.offline:
+        set_offline_mode()
+    else:
+        with startup_timer.stage("login"):
+            from huggingface_hub import login
+            token = os.getenv("HUGGINGFACE_HUB_TOKEN")
+            login(token)
     
     # record implement time
     implement_time = datetime.now()
     implement_time = implement_time.strftime("%Y%m%d-%H%M%S")
     
     # initialization
-    bench_args = _parse_args()
+    with startup_timer.stage("import_pipeline"):
+        from execution_pipeline import main
     if not os.path.dirname(bench_args.output_path):
         raise ValueError('You have to declare the directory!')
     bench_cfg = {
@@ -35,10 +60,23 @@ if __name__ == "__main__":
         'output_path': bench_args.output_path
     }
     if bench_args.bench_name.startswith("classification"):
-        agent_name = ClassificationAgent
+        with startup_timer.stage("import_agent"):
+            from code.ClassificationAgent import ClassificationAgent as agent_name
         agent_args = SimpleNamespace(**LLMArguments().__dict__, **ClassificationArguments().__dict__)
     elif bench_args.bench_name.startswith("sql_generation"):
-        agent_name = SQLGenerationAgent
+        with startup_timer.stage("import_agent"):
+            from code.SQLGenerationAgent import SQLGenerationAgent as agent_name
+        bench_cfg.update({
+            'schema_linking': bench_args.schema_linking,
+            'schema_token_budget': bench_args.schema_token_budget,
+            'sql_timeout': bench_args.sql_timeout,
+            'sql_max_vm_steps': bench_args.sql_max_vm_steps,
+            'sql_max_extra_rows': bench_args.sql_max_extra_rows,
+            'sql_sandbox': bench_args.sql_sandbox,
+            'sql_memory_budget_mb': bench_args.sql_memory_budget_mb,
+            'sql_submission_hash': bench_args.sql_submission_hash,
+            'eval_workers': bench_args.eval_workers
+        })
         agent_args = SimpleNamespace(**LLMArguments().__dict__, **SQLGenerationArguments().__dict__)
     else:
         raise ValueError(f"Invalid benchmark name: {bench_args.bench_name}")
@@ -52,13 +90,36 @@ if __name__ == "__main__":
         'do_sample': False,
         'device': agent_args.device,
         'use_8bit': agent_args.use_8bit,
+        'prefix_cache_size': agent_args.prefix_cache_size,
+        'stop_on_answer': agent_args.stop_on_answer,
+        'generation_cache_path': agent_args.generation_cache_path,
+        'generation_cache_size_mb': agent_args.generation_cache_size_mb,
+        'log_compression': agent_args.log_compression,
+        'log_dedup_prompts': agent_args.log_dedup_prompts,
+        'inference_mode': getattr(agent_args, 'inference_mode', 'generate'),
+        'score_batch_size': getattr(agent_args, 'score_batch_size', 4),
         'rag': {
             'embedding_model': rag_args.embedding_model,
             'seed': rag_args.seed,
             "top_k": rag_args.top_k,
             "order": rag_args.order,
+            "embedding_cache_size": rag_args.embedding_cache_size,
+            "load_dir": rag_args.load_dir,
         }
     }
     
-    agent = agent_name(config)
-    main(agent, bench_cfg)
+    with startup_timer.stage("agent_init"):
+        agent = agent_name(config)
+    main(
+        agent,
+        bench_cfg,
+        checkpoint_dir=bench_args.checkpoint_dir,
+        checkpoint_every=bench_args.checkpoint_every,
+        resume=bench_args.resume,
+        batch_size=bench_args.batch_size,
+        feedback_delay=bench_args.feedback_delay,
+        async_eval=bench_args.async_eval,
+        startup_timer=startup_timer if bench_args.startup_report else None
+    )
+    if rag_args.save_dir is not None:
+        agent.rag.save(rag_args.save_dir)
@@ -1,4 +1,5 @@
 import os
+import argparse
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 from tqdm import tqdm
@@ -28,6 +29,10 @@ def print_task_result(task, metrics, key):
     print(f"{Style.RESET_ALL}{'-' * 30}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save_gold_results', action='store_true', help='Store the results of the gold SQL so evaluation does not run it again')
+    args = parser.parse_args()
+
     print_header("Environment Setup Validation")
     
     for task, cls_ in TASKS.items():
@@ -47,6 +52,10 @@ if __name__ == "__main__":
                 time_step=time_step
             )
         metrics = bench.get_metrics()
+        if args.save_gold_results and hasattr(bench, "gold_store"):
+            bench.gold_store.save()
+            print(f"{Fore.BLUE}Gold results saved to {bench.gold_store.path}")
+        bench.close()
         print_task_result(task, metrics, task_key[task])
         
     print_header("Validation Complete")
@@ -1,34 +1,200 @@
-import torch
-import faiss
+import os
+import gzip
+import json
+import time
+import queue
+import hashlib
+import threading
 import random
 import logging
 import numpy as np
 from enum import Enum
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from pathlib import Path
-from transformers import AutoTokenizer, AutoModel
 
-class JSONLinesHandler(logging.FileHandler):
+class JSONLinesHandler(logging.Handler):
+    """Write the log records as JSON lines from a background thread.
+
+    Records queued while a batch is written are written together in the next batch, each batch being
+    appended as one gzip member or zstd frame when compression is enabled. With dedup_prompts, the
+    "input_pred" prompt of a record is split into "\n\n"-separated chunks, each chunk is written once
+    as a {"chunk_id", "text"} line, and the record keeps the list of its chunk ids ("input_pred_chunks").
+    """
+    def __init__(self, filename: str, compression: str = None, dedup_prompts: bool = False):
+        super().__init__()
+        if compression == "zstd":
+            import zstandard  # optional dependency, only needed for zstd logs
+            self.compressor = zstandard.ZstdCompressor()
+        elif compression not in [None, "gzip"]:
+            raise ValueError(f"Unknown log compression: {compression}")
+        self.baseFilename = filename
+        self.compression = compression
+        self.dedup_prompts = dedup_prompts
+        self.seen_chunks = set()
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
     def emit(self, record):
-        log_entry = self.format(record)
-        with open(self.baseFilename, 'a') as file:
-            file.write(f"{log_entry}\n")
+        # dict messages are serialized by the writer thread, off the step loop
+        self.queue.put(record)
+
+    @staticmethod
+    def json_default(value):
+        # NumPy scalars (e.g. np.int64 counters) are logged as Python numbers
+        if hasattr(value, "item"):
+            return value.item()
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    def dedup(self, entry: dict) -> list[dict]:
+        prompt = entry.get("input_pred")
+        if (not self.dedup_prompts) or not isinstance(prompt, str):
+            return [entry]
+        entries, chunk_ids = [], []
+        for chunk in prompt.split("\n\n"):
+            chunk_id = hashlib.sha1(chunk.encode()).hexdigest()[:16]
+            if chunk_id not in self.seen_chunks:
+                self.seen_chunks.add(chunk_id)
+                entries.append({"chunk_id": chunk_id, "text": chunk})
+            chunk_ids.append(chunk_id)
+        entry = {k: v for k, v in entry.items() if k != "input_pred"}
+        entry["input_pred_chunks"] = chunk_ids
+        entries.append(entry)
+        return entries
+
+    def write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                lines = []
+                for record in batch:
+                    if record is None:
+                        continue
+                    try:
+                        if isinstance(record.msg, dict):
+                            lines.extend(json.dumps(entry, default=self.json_default) for entry in self.dedup(record.msg))
+                        else:
+                            lines.append(self.format(record))
+                    except Exception:
+                        # the record is dropped, the next ones are still written
+                        self.handleError(record)
+                if lines:
+                    data = "".join(f"{line}\n" for line in lines).encode()
+                    if self.compression == "gzip":
+                        data = gzip.compress(data)
+                    elif self.compression == "zstd":
+                        data = self.compressor.compress(data)
+                    # opened per batch, so that the file can be replaced between batches (e.g. when resuming)
+                    with open(self.baseFilename, 'ab') as file:
+                        file.write(data)
+            except Exception:
+                self.handleError(next(record for record in batch if record is not None))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if None in batch:
+                return
+
+    def flush(self):
+        """Wait until the queued records are written (or the writer thread is gone)."""
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and self.writer.is_alive():
+                self.queue.all_tasks_done.wait(timeout=1.0)
+
+    def close(self):
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        super().close()
 
-def setup_logger(name, log_file, level=logging.INFO):
+def setup_logger(name, log_file, level=logging.INFO, compression=None, dedup_prompts=False):
     """Function to set up jsonlines logger."""
     Path(log_file).parent.mkdir(parents=True, exist_ok=True)
     with open(log_file, 'w') as file:
         pass  # create the file if it does not exist
 
+    # one logger per log file, so that several agents in a process do not write to each other's logs
+    logger = logging.getLogger(f"{name}.{log_file}")
+    logger.setLevel(level)
+    logger.propagate = False
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+        old_handler.close()
+
     formatter = logging.Formatter('%(message)s')  # Only message gets logged
-    handler = JSONLinesHandler(log_file)
+    handler = JSONLinesHandler(log_file, compression=compression, dedup_prompts=dedup_prompts)
     handler.setFormatter(formatter)
-
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
     logger.addHandler(handler)
 
     return logger
 
+def iter_log_records(log_file):
+    """Read back the records of a log written by JSONLinesHandler, with their prompts restored."""
+    if log_file.endswith(".zst"):
+        import zstandard
+        with open(log_file, 'rb') as f:
+            data = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True).read()
+    else:
+        opener = gzip.open if log_file.endswith(".gz") else open
+        with opener(log_file, 'rb') as f:
+            data = f.read()
+    chunks = dict()
+    for line in data.decode().splitlines():
+        entry = json.loads(line)
+        if "chunk_id" in entry:
+            chunks[entry["chunk_id"]] = entry["text"]
+            continue
+        if "input_pred_chunks" in entry:
+            entry["input_pred"] = "\n\n".join(chunks[chunk_id] for chunk_id in entry.pop("input_pred_chunks"))
+        yield entry
+
+class StageTimer:
+    """Record the wall-clock time spent in the named stages of each time step."""
+
+    def __init__(self) -> None:
+        self.samples = defaultdict(list)  # stage -> durations (in seconds) of the whole run
+        self.step_timings = defaultdict(float)  # stage -> seconds spent since the last pop_step()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.samples[name].append(seconds)
+        self.step_timings[name] += seconds
+
+    def pop_step(self) -> dict:
+        """Return the timings recorded since the last call, in seconds."""
+        timings = {name: round(seconds, 6) for name, seconds in self.step_timings.items()}
+        self.step_timings = defaultdict(float)
+        return timings
+
+    def summary(self) -> dict:
+        """Return the count, total and p50/p95/p99 (in seconds) of every stage."""
+        summary = dict()
+        for name, durations in self.samples.items():
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            summary[name] = {
+                "count": len(durations),
+                "total": float(np.sum(durations)),
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99)
+            }
+        return summary
+
+def set_offline_mode() -> None:
+    """Resolve models and datasets from the local Hugging Face cache only. Must be called before they are imported."""
+    for key in ["HF_HUB_OFFLINE", "TRANSFORMERS_OFFLINE", "HF_DATASETS_OFFLINE"]:
+        os.environ[key] = "1"
+
 def parse_pred_text(pred_text: str, label_set: set[str]) -> str:
     """A simple heuristic parsing function for compatibility with the label_set."""
     pred_text = pred_text.strip(" ().:")
@@ -49,11 +215,16 @@ class RetrieveOrder(Enum):
 class RAG:
 
     def __init__(self, rag_config: dict) -> None:
+        # the heavy libraries are only imported once a RAG store is built
+        from transformers import AutoTokenizer, AutoModel
         self.tokenizer = AutoTokenizer.from_pretrained(rag_config["embedding_model"])
         self.embed_model = AutoModel.from_pretrained(rag_config["embedding_model"]).eval()
         
         self.index = None
         self.id2evidence = dict()
+        # recently embedded texts, so that inserting a retrieved query does not encode it again
+        self.embedding_cache = OrderedDict()
+        self.embedding_cache_size = rag_config.get("embedding_cache_size", 64)
         self.embed_dim = len(self.encode_data("Test embedding size"))
         self.insert_acc = 0
         
@@ -64,40 +235,121 @@ class RAG:
         self.retrieve_order = rag_config["order"]
         random.seed(self.seed)
         
+        self.embedding_model = rag_config["embedding_model"]
         self.create_faiss_index()
-        # TODO: make a file to save the inserted rows
+        # warm-start from a previously saved experience store
+        if rag_config.get("load_dir"):
+            self.load(rag_config["load_dir"])
 
     def create_faiss_index(self):
         # Create a FAISS index
+        import faiss
         self.index = faiss.IndexFlatL2(self.embed_dim)
 
+    def save(self, save_dir: str) -> None:
+        """Save the FAISS index, the evidence store and the insert counter to save_dir."""
+        import faiss
+        Path(save_dir).mkdir(parents=True, exist_ok=True)
+        index_path = os.path.join(save_dir, "index.faiss")
+        evidence_path = os.path.join(save_dir, "evidence.json")
+        # write to temporary files first, so that an interrupted save keeps the previous store intact
+        faiss.write_index(self.index, index_path + ".tmp")
+        with open(evidence_path + ".tmp", 'w') as f:
+            json.dump({
+                "embedding_model": self.embedding_model,
+                "insert_acc": self.insert_acc,
+                "id2evidence": self.id2evidence
+            }, f)
+        os.replace(index_path + ".tmp", index_path)
+        os.replace(evidence_path + ".tmp", evidence_path)
+
+    def load(self, load_dir: str, mmap: bool = False) -> None:
+        """Load a store written by save(). With mmap=True the index is memory-mapped read-only, so no more rows can be inserted."""
+        import faiss
+        with open(os.path.join(load_dir, "evidence.json")) as f:
+            store = json.load(f)
+        if store["embedding_model"] != self.embedding_model:
+            raise ValueError(f"The store in {load_dir} was embedded with {store['embedding_model']}, not {self.embedding_model}")
+        io_flags = (faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY) if mmap else 0
+        index = faiss.read_index(os.path.join(load_dir, "index.faiss"), io_flags)
+        if (index.d != self.embed_dim) or (index.ntotal != store["insert_acc"]):
+            raise ValueError(f"The index in {load_dir} does not match its evidence store")
+        self.index = index
+        self.id2evidence = store["id2evidence"]
+        self.insert_acc = store["insert_acc"]
+
     def encode_data(self, sentence: str) -> np.ndarray:
-        # Tokenize the sentence
-        encoded_input = self.tokenizer([sentence], padding=True, truncation=True, return_tensors="pt")
-        # Compute token embeddings
-        with torch.no_grad():
-            model_output = self.embed_model(**encoded_input)
-            # Perform pooling. In this case, cls pooling.
-            sentence_embeddings = model_output[0][:, 0]
-        feature = sentence_embeddings.numpy()[0]
-        norm = np.linalg.norm(feature)
-        return feature / norm
+        return self.encode_batch([sentence])[0]
+
+    def encode_batch(self, sentences: list[str], batch_size: int = 32) -> np.ndarray:
+        """Embed the sentences with padded batches of the embedding model. Return normalized float32 vectors of shape (N, D).
+
+        Recently embedded sentences are served from the embedding cache.
+        """
+        missing = [sentence for sentence in dict.fromkeys(sentences) if sentence not in self.embedding_cache]
+        new_embeddings = dict(zip(missing, self._embed(missing, batch_size))) if len(missing) else dict()
+        embeddings = np.stack([
+            new_embeddings[sentence] if sentence in new_embeddings else self.embedding_cache[sentence]
+            for sentence in sentences
+        ])
+
+        # update the LRU cache
+        for sentence in sentences:
+            if sentence in self.embedding_cache:
+                self.embedding_cache.move_to_end(sentence)
+        for sentence, embedding in new_embeddings.items():
+            self.embedding_cache[sentence] = embedding.copy()  # do not keep the whole batch array alive
+        while len(self.embedding_cache) > self.embedding_cache_size:
+            self.embedding_cache.popitem(last=False)
+        return embeddings
+
+    def _embed(self, sentences: list[str], batch_size: int) -> np.ndarray:
+        import torch
+        features = []
+        for start in range(0, len(sentences), batch_size):
+            # Tokenize the sentences
+            encoded_input = self.tokenizer(sentences[start:start + batch_size], padding=True, truncation=True, return_tensors="pt")
+            # Compute token embeddings
+            with torch.no_grad():
+                model_output = self.embed_model(**encoded_input)
+                # Perform pooling. In this case, cls pooling.
+                sentence_embeddings = model_output[0][:, 0]
+            features.append(sentence_embeddings.numpy())
+        features = np.concatenate(features, axis=0)
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        return (features / norms).astype('float32')  # Ensure the data type is float32
 
     def insert(self, key: str, value: str) -> None:
         """Use the key text as the embedding for future retrieval of the value text."""
-        embedding = self.encode_data(key).astype('float32')  # Ensure the data type is float32
-        self.index.add(np.expand_dims(embedding, axis=0))
-        self.id2evidence[str(self.insert_acc)] = value
-        self.insert_acc += 1
+        self.insert_many([key], [value])
+
+    def insert_many(self, keys: list[str], values: list[str]) -> None:
+        """Embed all the keys in batches and add them to the index in one call."""
+        assert len(keys) == len(values)
+        if len(keys) == 0:
+            return
+        embeddings = self.encode_batch(keys)
+        self.index.add(embeddings)
+        for value in values:
+            self.id2evidence[str(self.insert_acc)] = value
+            self.insert_acc += 1
 
     def retrieve(self, query: str, top_k: int) -> list[str]:
         """Retrieve top-k text chunks"""
-        embedding = self.encode_data(query).astype('float32')  # Ensure the data type is float32
+        return self.retrieve_many([query], top_k)[0]
+
+    def retrieve_many(self, queries: list[str], top_k: int) -> list[list[str]]:
+        """Retrieve top-k text chunks for each query with a single index search."""
+        if len(queries) == 0:
+            return []
+        embeddings = self.encode_batch(queries)
         top_k = min(top_k, self.insert_acc)
-        distances, indices = self.index.search(np.expand_dims(embedding, axis=0), top_k)
-        distances = distances[0].tolist()
-        indices = indices[0].tolist()
-        
+        distances, indices = self.index.search(embeddings, top_k)
+        return [
+            self.order_results(dists, idxs) for dists, idxs in zip(distances.tolist(), indices.tolist())
+        ]
+
+    def order_results(self, distances: list[float], indices: list[int]) -> list[str]:
         results = [{'link': str(idx), '_score': {'faiss': dist}} for dist, idx in zip(distances, indices)]
         # Re-order the sequence based on self.retrieve_order
         if self.retrieve_order == RetrieveOrder.SIMILAR_AT_BOTTOM.value: